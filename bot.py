@@ -2,21 +2,52 @@
 # It will contain the core logic for connecting to Discord,
 # handling commands, and managing music playback.
 
+import time
+_BOOT_STARTED = time.perf_counter() # Taken before any other import so the boot report covers them
+
 import discord
 from discord.ext import commands
 import dotenv
 import os
-import yt_dlp
-import asyncio # Required for play_next_wrapper
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
+import asyncio
+import contextlib
 import re # For URL detection
 import random # For shuffling queue
+import collections
+import concurrent.futures
+import itertools
+import json
+import math
+import sqlite3
+import subprocess
+import threading
+
+# yt_dlp and spotipy are deliberately NOT imported here. They are by far the
+# heaviest imports and neither is needed to reach the gateway, so they are
+# loaded on first use (see get_yt_dlp / init_spotify_client) instead.
 
 # Load environment variables
 dotenv.load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 
+# Startup budget: time from process start to gateway ready, reported at boot.
+STARTUP_BUDGET_SECONDS = float(os.getenv('STARTUP_BUDGET_SECONDS', '10'))
+startup_timings = {} # Phase name: seconds since process start
+
+background_tasks = set() # Strong references to fire-and-forget tasks so they aren't garbage collected
+
+def spawn_background(coro):
+    """Schedules a coroutine on the bot loop and keeps a reference to it until it finishes."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def get_yt_dlp():
+    """Returns the yt_dlp module, importing it on first use."""
+    import yt_dlp
+    return yt_dlp
+
 # Helper function for formatting duration
 def format_duration(duration_seconds):
     if not duration_seconds or duration_seconds <= 0:
@@ -48,33 +79,137 @@ async def user_in_same_voice_channel(ctx):
     return True # If all checks pass
 
 # Spotipy client setup
+# The client is created in the background once the bot is ready (see on_ready),
+# so a slow import or credentials request never delays the gateway connection.
 SPOTIPY_CLIENT_ID = os.getenv('SPOTIPY_CLIENT_ID')
 SPOTIPY_CLIENT_SECRET = os.getenv('SPOTIPY_CLIENT_SECRET')
 sp = None
-if SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET:
+spotify_status = 'pending' if SPOTIPY_CLIENT_ID and SPOTIPY_CLIENT_SECRET else 'disabled' # 'pending', 'ready', 'error' or 'disabled'
+
+def _create_spotify_client():
+    """Imports spotipy and builds the client. Blocking, run it in a thread."""
+    import spotipy
+    from spotipy.oauth2 import SpotifyClientCredentials
+    auth_manager = SpotifyClientCredentials(client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET)
+    return spotipy.Spotify(auth_manager=auth_manager)
+
+async def init_spotify_client():
+    """Initializes the global Spotipy client without blocking the event loop."""
+    global sp, spotify_status
+    if spotify_status == 'disabled':
+        print("Spotipy client ID or secret not found in environment variables. Spotify features will be unavailable.")
+        return
+    started = time.perf_counter()
     try:
-        auth_manager = SpotifyClientCredentials(client_id=SPOTIPY_CLIENT_ID, client_secret=SPOTIPY_CLIENT_SECRET)
-        sp = spotipy.Spotify(auth_manager=auth_manager)
-        print("Spotipy client initialized successfully.")
+        sp = await asyncio.to_thread(_create_spotify_client)
+        spotify_status = 'ready'
+        print(f"Spotipy client initialized successfully in {time.perf_counter() - started:.2f}s.")
     except Exception as e:
         print(f"Error initializing Spotipy client: {e}. Spotify features will be unavailable.")
         sp = None # Ensure sp is None on error
-else:
-    print("Spotipy client ID or secret not found in environment variables. Spotify features will be unavailable.")
-    sp = None
+        spotify_status = 'error'
+
+async def warm_up_yt_dlp():
+    """Imports yt_dlp in a worker thread so the first !play doesn't pay for it."""
+    started = time.perf_counter()
+    await asyncio.to_thread(get_yt_dlp)
+    print(f"yt-dlp loaded in the background in {time.perf_counter() - started:.2f}s.")
+
+QUEUE_HISTORY_LIMIT = 50 # Played songs kept for !previous, unless the whole queue is looping
+
+class GuildQueue:
+    """A guild's songs with a cursor over them.
+
+    items[cursor] is the song playing (or last played), everything after it is
+    up next and everything before it is history. Moving to the next song, song
+    loop, queue loop and !previous only move the cursor; songs are never copied
+    or re-inserted, so looping costs no memory however often it wraps.
+
+    len(), truth value, iteration and indexing all refer to the songs up next,
+    so a GuildQueue reads like the plain list it replaced.
+    """
+
+    def __init__(self):
+        self.items = []
+        self.cursor = -1
+
+    def __len__(self):
+        return len(self.items) - self.cursor - 1
+
+    def __iter__(self):
+        return itertools.islice(self.items, self.cursor + 1, None)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        if not 0 <= index < len(self):
+            raise IndexError("queue index out of range")
+        return self.items[self.cursor + 1 + index]
+
+    def append(self, song_item):
+        self.items.append(song_item)
+
+    def extend(self, song_items):
+        self.items.extend(song_items)
+
+    def clear(self):
+        """Forgets every song, history included."""
+        self.items.clear()
+        self.cursor = -1
+
+    def shuffle(self):
+        """Shuffles the songs up next; history and the current song stay where they are."""
+        upcoming = self.items[self.cursor + 1:]
+        random.shuffle(upcoming)
+        self.items[self.cursor + 1:] = upcoming
+
+    def advance(self, loop_mode='off', keep_history=False):
+        """Moves the cursor to the song that should play next and returns it, or None if there is none.
+
+        'song' repeats the song under the cursor, 'queue' wraps around to the
+        first song after the last one. keep_history is for when the whole queue
+        is looping, even if this particular move doesn't wrap (e.g. after
+        !previous): played songs come around again, so they are never trimmed.
+        """
+        if loop_mode == 'song' and 0 <= self.cursor < len(self.items):
+            return self.items[self.cursor]
+        if self.cursor + 1 < len(self.items):
+            self.cursor += 1
+        elif loop_mode == 'queue' and self.items:
+            self.cursor = 0
+        else:
+            return None
+        if loop_mode != 'queue' and not keep_history and self.cursor > 2 * QUEUE_HISTORY_LIMIT:
+            # Trim history in chunks so this stays O(1) amortized
+            drop = self.cursor - QUEUE_HISTORY_LIMIT
+            del self.items[:drop]
+            self.cursor -= drop
+        return self.items[self.cursor]
+
+    def rewind(self, playing):
+        """Moves the cursor back so the next advance() returns the previous song, and returns that song.
+
+        When nothing is playing the song under the cursor already finished, so
+        it is the one to go back to. Returns None if there is no history.
+        """
+        target = self.cursor - 1 if playing else self.cursor
+        if target < 0 or target >= len(self.items):
+            return None
+        self.cursor = target - 1
+        return self.items[target]
 
 # Bot setup
-song_queues = {} # Guild ID: [list of song_item dictionaries]
+song_queues = {} # Guild ID: GuildQueue
 current_song_info = {} # Guild ID: song_item
-guild_audio_sources = {} # Guild ID: discord.PCMVolumeTransformer
+guild_audio_sources = {} # Guild ID: TrackedAudio
 active_control_messages = {} # Guild ID: discord.Message object for current playback controls
-guild_loop_states = {} # Guild ID: 'off' or 'song' (or 'queue' in future)
+guild_loop_states = {} # Guild ID: 'off', 'song' or 'queue'
 
 # song_item structure (for reference):
 # {
 # 'query': str, 'source_type': str, 'title': str, 'webpage_url': str, 
 # 'thumbnail_url': str, 'duration': int, 'uploader': str, 
-# 'stream_url': str, 'requester': str, 'requester_avatar_url': str
+# 'stream_url': str, 'acodec': str, 'resolved_at': float, 'requester': str, 'requester_id': int, 'requester_avatar_url': str
 # }
 
 intents = discord.Intents.default()
@@ -84,156 +219,789 @@ intents.guild_messages = True
 intents.voice_states = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
+def report_startup():
+    """Prints how long each boot phase took against STARTUP_BUDGET_SECONDS."""
+    ready_after = startup_timings['gateway_ready']
+    print(f"Startup: module loaded in {startup_timings.get('module_loaded', 0):.2f}s, "
+          f"gateway ready after {ready_after:.2f}s (budget {STARTUP_BUDGET_SECONDS:.2f}s).")
+    if ready_after > STARTUP_BUDGET_SECONDS:
+        print(f"Warning: startup exceeded its budget by {ready_after - STARTUP_BUDGET_SECONDS:.2f}s.")
+
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user.name} (ID: {bot.user.id})")
     print("------")
+    # on_ready fires again after every reconnect; only the first one is the cold start.
+    if 'gateway_ready' not in startup_timings:
+        startup_timings['gateway_ready'] = time.perf_counter() - _BOOT_STARTED
+        report_startup()
+        spawn_background(init_spotify_client())
+        spawn_background(warm_up_yt_dlp())
+        spawn_background(idle_reaper())
+        spawn_background(stream_watchdog())
+        if LOCAL_MUSIC_DIR:
+            spawn_background(library_scanner())
+
+STREAM_URL_MAX_AGE_SECONDS = 4 * 3600 # YouTube stream URLs expire after about 6 hours
+
+def stream_url_expired(song_item):
+    """True if the song's stream URL was resolved long enough ago that it may no longer work."""
+    resolved_at = song_item.get('resolved_at')
+    return resolved_at is not None and time.time() - resolved_at > STREAM_URL_MAX_AGE_SECONDS
+
+PREFETCH_LEAD_SECONDS = 30 # Resolve the next unresolved song this long before the current one ends
+MAX_CONSECUTIVE_PLAY_FAILURES = int(os.getenv('MAX_CONSECUTIVE_PLAY_FAILURES', '5')) # Failed tracks in a row before the player gives up
+
+def source_display_name(song_item):
+    """Human readable name of where a song_item came from."""
+    source_display = {
+        'youtube': 'YouTube',
+        'spotify_via_youtube': 'Spotify (via YouTube)',
+        'soundcloud': 'SoundCloud',
+        'local': 'Local Library',
+        'search': 'Search (YouTube)' # ytsearch will be 'youtube' from extractor
+    }.get(song_item.get('source_type'), 'Unknown Source')
+    if song_item.get('source_type') == 'youtube' and 'ytsearch' in song_item.get('query','').lower():
+        source_display = 'Search (YouTube)'
+    return source_display
+
+def queue_entry_title(song_item):
+    """Song title as a markdown link, or plain text when it has no web page (local files)."""
+    if song_item.get('webpage_url'):
+        return f"[{song_item['title']}]({song_item['webpage_url']})"
+    return song_item['title']
+
+def now_playing_embed(song_item, color):
+    """Builds the 'Now Playing' embed shared by the player, !queue and !nowplaying."""
+    embed = discord.Embed(
+        title=song_item['title'],
+        url=song_item.get('webpage_url'),
+        color=color
+    )
+    embed.set_author(name=f"Now Playing (Requested by: {song_item['requester']})", icon_url=song_item.get('requester_avatar_url'))
+    if song_item.get('thumbnail_url'):
+        embed.set_thumbnail(url=song_item['thumbnail_url'])
+
+    embed.add_field(name="Channel/Uploader", value=song_item.get('uploader', 'N/A'), inline=True)
+    embed.add_field(name="Duration", value=format_duration(song_item.get('duration')), inline=True)
+    embed.add_field(name="Source", value=source_display_name(song_item), inline=True)
+    return embed
+
+async def disable_control_message(guild_id, message=None):
+    """Disables the buttons on a guild's control message (the active one unless given) and forgets it."""
+    if message is None:
+        message = active_control_messages.pop(guild_id, None)
+    elif active_control_messages.get(guild_id) == message:
+        active_control_messages.pop(guild_id, None)
+    if not message:
+        return
+    try:
+        # Create a new view with all buttons disabled for the old message
+        disabled_view = PlaybackControlView()
+        for child in disabled_view.children:
+            child.disabled = True
+        await message.edit(view=disabled_view)
+    except discord.NotFound:
+        pass # Old message might have been deleted
+    except Exception as ex:
+        print(f"Error editing old control message: {ex}")
+
+class PlayerClosed(Exception):
+    """Raised to callers waiting on a command of a player whose guild state was dropped."""
+
+class GuildPlayer:
+    """Runs playback for a single guild as an actor.
+
+    Every change to a guild's song_queues / current_song_info entry goes
+    through this player's mailbox and is applied by one task, one command at a
+    time. Commands, button callbacks and the audio thread's 'after' callback
+    only post commands, so they can never interleave half-way through a change.
+    """
 
-async def play_next(ctx):
-    """Plays the next song in the queue for the guild."""
-    guild_id = ctx.guild.id
-    if guild_id in song_queues and song_queues[guild_id]:
-        song_item = song_queues[guild_id].pop(0)
-        current_song_info[guild_id] = song_item
-        
-        voice_client = ctx.voice_client
-        if voice_client and voice_client.is_connected():
+    def __init__(self, guild):
+        self.guild = guild
+        self.channel = None # Text channel that receives "Now Playing" and status messages
+        self.state = 'idle' # 'idle' or 'playing'
+        self.generation = 0 # Bumped for every source started, so 'after' callbacks of replaced sources are ignored
+        self.failures = 0 # Consecutive tracks that failed to play
+        self.skip_requested = False # Set by skip so song loop doesn't replay the skipped song
+        self.closed = False # Set once the guild's state was reclaimed; the task then exits
+        self.reclaim_posted = False # A 'reclaim' is waiting in the mailbox, so the reaper doesn't post another
+        self.prefetch_task = None # Resolves the next unresolved song shortly before it's needed
+        self.mailbox = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    def post(self, command, **kwargs):
+        """Queues a command without waiting for it. Must be called from the event loop."""
+        self.mailbox.put_nowait((command, kwargs, None))
+
+    async def send(self, command, **kwargs):
+        """Queues a command and waits for the player to apply it. Returns the handler's result."""
+        future = asyncio.get_running_loop().create_future()
+        self.mailbox.put_nowait((command, kwargs, future))
+        return await future
+
+    async def _run(self):
+        while not self.closed:
+            command, kwargs, future = await self.mailbox.get()
             try:
-                ffmpeg_audio = discord.FFmpegPCMAudio(song_item['stream_url'], **FFMPEG_OPTS)
-                audio_source_transformed = discord.PCMVolumeTransformer(ffmpeg_audio)
-                voice_client.play(audio_source_transformed, after=lambda e: play_next_wrapper(ctx, e))
-                guild_audio_sources[guild_id] = audio_source_transformed
+                result = await getattr(self, f"_on_{command}")(**kwargs)
+            except asyncio.CancelledError:
+                # The guild's state was dropped (see close) while this command ran
+                if future and not future.done():
+                    future.set_exception(PlayerClosed(f"Player of guild {self.guild.id} was closed."))
+                raise
+            except Exception as e:
+                print(f"Player error in guild {self.guild.id} while handling '{command}': {e}")
+                if future and not future.done():
+                    future.set_exception(e)
+            else:
+                if future and not future.done():
+                    future.set_result(result)
+
+        # Commands that arrived after the guild was reclaimed go to a fresh player
+        while not self.mailbox.empty():
+            get_player(self.guild).mailbox.put_nowait(self.mailbox.get_nowait())
+
+    def close(self):
+        """Stops the player from outside its task. Callers still waiting on a command get PlayerClosed."""
+        self.closed = True
+        self._cancel_prefetch()
+        while not self.mailbox.empty():
+            _, _, future = self.mailbox.get_nowait()
+            if future and not future.done():
+                future.set_exception(PlayerClosed(f"Player of guild {self.guild.id} was closed."))
+        self.task.cancel()
+
+    def _after_playback(self, generation, error):
+        """'after' callback for voice_client.play. Runs on the audio thread, so it only posts back to the loop."""
+        bot.loop.call_soon_threadsafe(lambda: self.post('track_end', generation=generation, error=error))
+
+    # Command handlers. Only ever called from _run.
+
+    async def _on_enqueue(self, items, channel):
+        """Adds song items to the queue, as far as the queue limits allow, and starts playback if the player is idle.
+        Returns the items that were queued."""
+        guild_id = self.guild.id
+        self.channel = channel
+        mark_guild_active(guild_id)
+        room = {} # Requester ID: songs they may still add
+        accepted = []
+        for item in items:
+            requester_id = item.get('requester_id')
+            if requester_id not in room:
+                room[requester_id] = queue_room(guild_id, requester_id)
+            if room[requester_id] > 0:
+                room[requester_id] -= 1
+                accepted.append(item)
+        if len(accepted) < len(items):
+            admission_stats['queue_full'] += len(items) - len(accepted)
+        self._queue().extend(accepted)
+        if accepted and self.state == 'idle':
+            voice_client = self.guild.voice_client
+            if voice_client and voice_client.is_connected():
+                self.failures = 0
+                await self._play_next()
+            else:
+                await self.channel.send("Bot is not connected to a voice channel anymore.")
+        return accepted
+
+    async def _on_track_end(self, generation, error):
+        if generation != self.generation:
+            return # The source was replaced or stopped on purpose
+        guild_id = self.guild.id
+        if error:
+            print(f'Player error in guild {guild_id}: {error}')
+            self.failures += 1
+        else:
+            self.failures = 0
 
-                embed = discord.Embed(
-                    title=song_item['title'], 
-                    url=song_item['webpage_url'], 
-                    color=discord.Color.blue()
-                )
-                embed.set_author(name=f"Now Playing (Requested by: {song_item['requester']})", icon_url=song_item['requester_avatar_url'])
-                if song_item.get('thumbnail_url'):
-                    embed.set_thumbnail(url=song_item['thumbnail_url'])
-                
-                embed.add_field(name="Channel/Uploader", value=song_item.get('uploader', 'N/A'), inline=True)
-                embed.add_field(name="Duration", value=format_duration(song_item.get('duration')), inline=True)
-                source_display = {
-                    'youtube': 'YouTube',
-                    'spotify_via_youtube': 'Spotify (via YouTube)',
-                    'soundcloud': 'SoundCloud',
-                    'search': 'Search (YouTube)' # ytsearch will be 'youtube' from extractor
-                }.get(song_item.get('source_type'), 'Unknown Source')
-                if song_item.get('source_type') == 'youtube' and 'ytsearch' in song_item.get('query','').lower():
-                    source_display = 'Search (YouTube)'
-
-                embed.add_field(name="Source", value=source_display, inline=True)
-                
-                # Manage active control messages
-                if guild_id in active_control_messages and active_control_messages[guild_id]:
-                    try:
-                        old_message = active_control_messages[guild_id]
-                        # Create a new view with all buttons disabled for the old message
-                        disabled_view = PlaybackControlView()
-                        for child in disabled_view.children:
-                            child.disabled = True
-                        await old_message.edit(view=disabled_view)
-                    except discord.NotFound:
-                        pass # Old message might have been deleted
-                    except Exception as ex:
-                        print(f"Error editing old control message: {ex}")
-                
-                view = PlaybackControlView()
-                # We need a way to update button states correctly here.
-                # For now, buttons will have default states. Pause/Resume handles itself on click.
-                # Skip/Stop might be enabled even if queue is empty after this song.
-                # This will be improved by view.update_button_states in a follow-up if needed.
-                
-                new_message = await ctx.send(embed=embed, view=view)
-                active_control_messages[guild_id] = new_message
-                # await view.update_button_states(ctx) # Requires passing ctx or interaction to view or this method
+        loop_mode = guild_loop_states.get(guild_id, 'off')
+        if loop_mode == 'song' and (error or self.skip_requested):
+            loop_mode = 'off' # Skipped or broken songs aren't repeated
+        self.skip_requested = False
+        await self._play_next(loop_mode)
 
+    async def _on_skip(self):
+        """Stops the current song; its 'after' callback then advances the queue."""
+        voice_client = self.guild.voice_client
+        if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
+            self.skip_requested = True
+            voice_client.stop()
+            return True
+        return False
+
+    async def _on_previous(self):
+        """Goes back to the previous song. Returns it, or None if there is no history."""
+        guild_id = self.guild.id
+        voice_client = self.guild.voice_client
+        if not voice_client or not voice_client.is_connected():
+            return None
+        song_item = self._queue().rewind(playing=guild_id in current_song_info)
+        if song_item is None:
+            return None
+        self.generation += 1 # The interrupted song's 'after' callback must not advance the queue again
+        self.skip_requested = False
+        if voice_client.is_playing() or voice_client.is_paused():
+            voice_client.stop()
+        self.failures = 0
+        await self._play_next()
+        return song_item
+
+    async def _on_stop(self):
+        """Clears the queue, stops playback and disconnects. Returns True if anything was playing."""
+        guild_id = self.guild.id
+        self.generation += 1 # The 'after' callback of the stopped source must not start the next song
+        self.state = 'idle'
+        self._cancel_prefetch()
+        cancel_playlist_ingestion(self.guild.id)
+        self.skip_requested = False
+        voice_client = self.guild.voice_client
+        was_playing = bool(voice_client and (voice_client.is_playing() or voice_client.is_paused()))
+
+        if guild_id in song_queues:
+            song_queues[guild_id].clear()
+        current_song_info.pop(guild_id, None)
+        guild_audio_sources.pop(guild_id, None)
+        if guild_id in guild_radios:
+            guild_radios[guild_id].reset()
+
+        if voice_client:
+            if was_playing:
+                voice_client.stop()
+            if voice_client.is_connected():
+                await voice_client.disconnect()
+        await disable_control_message(guild_id)
+        return was_playing
+
+    async def _on_reclaim(self, reason=None):
+        """Disconnects and drops all of the guild's state, unless it became active again meanwhile."""
+        self.reclaim_posted = False
+        guild_id = self.guild.id
+        if not is_guild_idle(self.guild) or idle_for(guild_id, time.monotonic()) < IDLE_DISCONNECT_SECONDS:
+            return False # e.g. a !play came in after the reaper posted this
+        self.generation += 1
+        self._cancel_prefetch()
+        voice_client = self.guild.voice_client
+        if voice_client:
+            if voice_client.is_playing() or voice_client.is_paused():
+                voice_client.stop()
+            if voice_client.is_connected():
+                await voice_client.disconnect()
+        if reason and self.channel:
+            await self.channel.send(reason)
+        await disable_control_message(guild_id)
+        self.closed = True
+        drop_guild_state(guild_id)
+        return True
+
+    async def _on_disconnected(self):
+        """The bot left the voice channel: stops and forgets the playback, keeping the guild's settings."""
+        self.generation += 1
+        self._cancel_prefetch()
+        self.state = 'idle'
+        await disable_control_message(self.guild.id)
+        drop_playback_state(self.guild.id)
+
+    async def _on_rebuild(self):
+        """Restarts the current song's ffmpeg process at the current position, e.g. after a filter change."""
+        guild_id = self.guild.id
+        song_item = current_song_info.get(guild_id)
+        audio_source = guild_audio_sources.get(guild_id)
+        if not song_item or not isinstance(audio_source, TrackedAudio):
+            return False
+        position = audio_source.position
+        ffmpeg_audio = create_ffmpeg_source(song_item, guild_id, start_at=position, volume=audio_source.volume)
+        audio_source.replace_original(ffmpeg_audio, position, playback_speed(guild_id))
+        return True
+
+    async def _on_recover(self, audio_source):
+        """Rebuilds a stalled source at its current position from a freshly resolved stream URL.
+        Skips the song instead if that fails or it kept stalling."""
+        guild_id = self.guild.id
+        song_item = current_song_info.get(guild_id)
+        voice_client = self.guild.voice_client
+        try:
+            if guild_audio_sources.get(guild_id) is not audio_source or not song_item:
+                return False # The song changed since the stall was reported
+            recovered = False
+            if audio_source.recoveries < STALL_MAX_RECOVERIES:
+                audio_source.recoveries += 1
+                if song_item.get('source_type') == 'local':
+                    recovered = True # Nothing to resolve, a new ffmpeg process is all it takes
+                else:
+                    try:
+                        youtube_info = await fetch_youtube_info(song_item['webpage_url'], priority=PRIORITY_PLAY_NOW, guild_id=guild_id, fresh=True)
+                    except ResolverSaturated:
+                        youtube_info = None
+                    if youtube_info:
+                        song_item['stream_url'] = youtube_info['stream_url']
+                        song_item['acodec'] = youtube_info.get('acodec')
+                        song_item['resolved_at'] = time.time()
+                        recovered = True
+            if guild_audio_sources.get(guild_id) is not audio_source or not voice_client or voice_client.source is not audio_source:
+                return False # Ended or replaced while we were resolving
+            if not recovered:
+                stream_health['failed_recoveries'] += 1
+                if self.channel:
+                    await self.channel.send(f"'{song_item['title']}' keeps stalling, skipping it.")
+                self.skip_requested = True
+                voice_client.stop()
+                return False
+            position = audio_source.position
+            ffmpeg_audio = create_ffmpeg_source(song_item, guild_id, start_at=position, volume=audio_source.volume)
+            audio_source.replace_original(ffmpeg_audio, position, playback_speed(guild_id))
+            stream_health['recoveries'] += 1
+            return True
+        finally:
+            audio_source.recovering = False
+
+    async def _on_shuffle(self):
+        """Randomizes the order of the queued songs. Returns False if there was nothing to shuffle."""
+        queue = song_queues.get(self.guild.id)
+        if not queue:
+            return False
+        queue.shuffle()
+        return True
+
+    def _schedule_prefetch(self, playing_item):
+        """Arranges for the next queued song to be resolved PREFETCH_LEAD_SECONDS before playing_item ends."""
+        self._cancel_prefetch()
+        self.prefetch_task = spawn_background(self._prefetch(playing_item.get('duration') or 0))
+
+    def _cancel_prefetch(self):
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+
+    async def _prefetch(self, playing_duration):
+        await asyncio.sleep(max(0, playing_duration - PREFETCH_LEAD_SECONDS))
+        queue = song_queues.get(self.guild.id)
+        if queue and not queue[0].get('stream_url'):
+            # Warms resolved_info_cache; _play_next then resolves the song instantly
+            await resolve_song_item(queue[0], guild_id=self.guild.id)
+        if queue and get_audio_filters(self.guild.id)['normalize']:
+            await measure_loudness(queue[0], self.guild.id) # Ready before it plays, so it's normalized in a single pass
+
+    def _queue(self):
+        return song_queues.setdefault(self.guild.id, GuildQueue())
+
+    async def _play_next(self, loop_mode='off'):
+        """Plays the next playable song in the queue, following loop_mode ('off', 'song' or 'queue').
+
+        Songs that fail to start are skipped in a loop (never by recursion), and
+        the player gives up after MAX_CONSECUTIVE_PLAY_FAILURES in a row.
+        """
+        guild_id = self.guild.id
+        queue = self._queue()
+        self.state = 'idle' # Until a song has actually started, so an error on the way can't leave a stale 'playing'
+        ran_dry = False
+        keep_history = guild_loop_states.get(guild_id) == 'queue' # loop_mode is 'off' after !previous or an enqueue
+        while True:
+            voice_client = self.guild.voice_client
+            if not voice_client or not voice_client.is_connected():
+                break
+            if self.failures >= MAX_CONSECUTIVE_PLAY_FAILURES:
+                await self.channel.send(
+                    f"{self.failures} songs in a row failed to play, pausing the queue. "
+                    "Use `!play` to add a song and try again."
+                )
+                self.failures = 0
+                break
+
+            song_item = queue.advance(loop_mode, keep_history)
+            radio = guild_radios.get(guild_id)
+            if song_item is None and radio:
+                queue.extend(radio.take()) # Queue ran dry: continue with a related song, if one is ready
+                song_item = queue.advance(keep_history=keep_history)
+            if song_item is None:
+                ran_dry = True
+                break
+            if loop_mode == 'song':
+                loop_mode = 'off' # If the repeated song fails, move on instead of retrying it
+            current_song_info[guild_id] = song_item
+            if stream_url_expired(song_item):
+                song_item['stream_url'] = None # Looped long enough for the stream URL to expire
+            if not song_item.get('stream_url') and not await resolve_song_item(song_item, guild_id=guild_id):
+                self.failures += 1
+                await self.channel.send(f"Could not load '{song_item['title']}', skipping it.")
+                current_song_info.pop(guild_id, None)
+                continue
+            try:
+                self.generation += 1
+                generation = self.generation
+                ffmpeg_audio = create_ffmpeg_source(song_item, guild_id)
+                audio_source_transformed = TrackedAudio(ffmpeg_audio, speed=playback_speed(guild_id))
+                # Encode PCM at the channel's bitrate; more would be thrown away by Discord anyway
+                encoder_kbps = min(max(channel_bitrate_kbps(self.guild) or 128, 16), 512)
+                voice_client.play(audio_source_transformed, after=lambda e: self._after_playback(generation, e), bitrate=encoder_kbps)
+                guild_audio_sources[guild_id] = audio_source_transformed
             except Exception as e:
-                await ctx.send(f"Error playing next song '{song_item['title']}': {e}")
+                self.failures += 1
+                await self.channel.send(f"Error playing next song '{song_item['title']}': {e}")
                 current_song_info.pop(guild_id, None)
-                if guild_id in guild_audio_sources: del guild_audio_sources[guild_id]
-                await play_next(ctx) 
-        else:
-            if guild_id in song_queues: song_queues[guild_id].clear()
-            current_song_info.pop(guild_id, None)
-            if guild_id in guild_audio_sources: del guild_audio_sources[guild_id]
-    elif ctx.voice_client and ctx.voice_client.is_connected():
-        await ctx.send("Queue finished.")
-        current_song_info.pop(guild_id, None)
-        if guild_id in guild_audio_sources: del guild_audio_sources[guild_id]
-        # If queue finishes, disable controls on the last message
-        if guild_id in active_control_messages and active_control_messages[guild_id]:
+                guild_audio_sources.pop(guild_id, None)
+                continue
+
+            self.state = 'playing'
+            self._schedule_prefetch(song_item)
+            if radio:
+                radio.remember(song_item)
+                if len(queue) < RADIO_PREFETCH:
+                    radio.fill() # Related songs are resolved before the queue runs out
+            await disable_control_message(guild_id)
+            view = PlaybackControlView()
             try:
-                last_message = active_control_messages.pop(guild_id)
-                if last_message: # Check if it wasn't already None
-                    # Create a new view with all buttons disabled for the old message
-                    disabled_view = PlaybackControlView()
-                    for child in disabled_view.children:
-                        child.disabled = True
-                    await last_message.edit(view=disabled_view)
-            except discord.NotFound:
-                pass # Old message might have been deleted
-            except Exception as ex:
-                print(f"Error editing old control message on queue end: {ex}")
+                new_message = await self.channel.send(embed=now_playing_embed(song_item, discord.Color.blue()), view=view)
+            except discord.HTTPException as e: # e.g. Forbidden: the song plays on without its message
+                print(f"Could not send the Now Playing message in guild {guild_id}: {e}")
+            else:
+                active_control_messages[guild_id] = new_message
+            return
 
-    else: # Bot not connected, or some other case where playback stops
+        # Nothing (more) to play
+        self.state = 'idle'
         current_song_info.pop(guild_id, None)
-        if guild_id in song_queues: song_queues[guild_id].clear()
-        if guild_id in guild_audio_sources: del guild_audio_sources[guild_id]
-        # Also try to disable controls if bot is not connected anymore
-        if guild_id in active_control_messages and active_control_messages[guild_id]:
-            try:
-                last_message = active_control_messages.pop(guild_id)
-                if last_message:
-                    disabled_view = PlaybackControlView()
-                    for child in disabled_view.children:
-                        child.disabled = True
-                    await last_message.edit(view=disabled_view)
-            except discord.NotFound:
-                pass
-            except Exception as ex:
-                print(f"Error editing old control message on disconnect: {ex}")
+        guild_audio_sources.pop(guild_id, None)
+        voice_client = self.guild.voice_client
+        radio = guild_radios.get(guild_id)
+        if voice_client and voice_client.is_connected():
+            if ran_dry and radio:
+                radio.fill(play_now=True) # Enqueues the first related song it finds; the mailbox isn't held up meanwhile
+            elif not song_queues.get(guild_id) and self.channel:
+                await self.channel.send("Queue finished.")
+        elif guild_id in song_queues: # Bot not connected anymore, nothing can be played
+            song_queues[guild_id].clear()
+        await disable_control_message(guild_id)
+
+guild_players = {} # Guild ID: GuildPlayer
+
+def get_player(guild):
+    """Returns the guild's GuildPlayer, creating it on first use."""
+    player = guild_players.get(guild.id)
+    if player is None:
+        player = GuildPlayer(guild)
+        guild_players[guild.id] = player
+    return player
+
+
+# Autoplay
+# With autoplay on, the queue never runs dry: related songs are taken from the
+# YouTube Mix (the "RD" radio playlist) of recently played songs. The next
+# RADIO_PREFETCH of them are resolved in the background while the last queued
+# songs play, so the switch to the radio needs no lookup at all. If the queue
+# runs dry before one is ready, the lookups jump to PRIORITY_PLAY_NOW and the
+# first song found is enqueued on its own, without holding up the player.
+RADIO_PREFETCH = 2 # Related songs kept resolved and ready
+RADIO_HISTORY_SIZE = 200 # Recently played video IDs never picked again
+RADIO_SEED_SONGS = 3 # Mixes of this many of the last played songs are used in turn
+RADIO_MIX_SIZE = 25 # Entries read from each mix
+
+def song_video_id(song_item):
+    """The YouTube video ID of a song, or None if it isn't a YouTube video."""
+    match = re.search(YOUTUBE_VIDEO_ID_REGEX, song_item.get('webpage_url') or '')
+    return match.group(1) if match else None
+
+class GuildRadio:
+    """Autoplay state of a guild: related songs found and resolved ahead of time, and what played recently."""
+
+    def __init__(self, guild):
+        self.guild = guild
+        self.history = collections.deque(maxlen=RADIO_HISTORY_SIZE) # Recently played video IDs, oldest first
+        self.seen = set() # Same IDs as history, for O(1) lookups
+        self.seeded = set() # Video IDs whose mix was already used
+        self.candidates = collections.deque() # Flat mix entries not tried yet
+        self.ready = [] # Resolved song items, next first
+        self.fill_task = None
+        self.waiting = False # The queue ran dry, so the next song found goes straight to the player
+
+    def remember(self, song_item):
+        video_id = song_video_id(song_item)
+        if not video_id or video_id in self.seen:
+            return
+        if len(self.history) == self.history.maxlen:
+            self.seen.discard(self.history[0])
+        self.history.append(video_id)
+        self.seen.add(video_id)
+
+    def reset(self):
+        """Forgets the songs found so far, e.g. after !stop."""
+        if self.fill_task:
+            self.fill_task.cancel()
+            self.fill_task = None
+        self.waiting = False
+        self.candidates.clear()
+        self.ready.clear()
+
+    def fill(self, play_now=False):
+        """Starts resolving related songs up to RADIO_PREFETCH, unless that's already running. Returns the task.
+
+        play_now is for when the queue already ran dry: lookups are made at
+        PRIORITY_PLAY_NOW until the first song is found, which is enqueued right away.
+        """
+        if play_now and not self.waiting:
+            self.waiting = True
+            if self.fill_task and not self.fill_task.done():
+                self.fill_task.cancel() # Its lookups wait behind the bulk work; start over at play-now priority
+                self.fill_task = None
+        if not self.fill_task or self.fill_task.done():
+            self.fill_task = spawn_background(self._fill())
+        return self.fill_task
+
+    def take(self):
+        """The next ready related song as a one-item list, or an empty list if none is ready yet."""
+        return [self.ready.pop(0)] if self.ready else []
+
+    def _deliver(self, song_item):
+        """Hands the first song found after the queue ran dry to the player."""
+        self.waiting = False
+        player = guild_players.get(self.guild.id)
+        if player and player.state == 'idle':
+            player.post('enqueue', items=[song_item], channel=player.channel)
+        else:
+            self.ready.append(song_item) # Something else was played meanwhile
 
-def play_next_wrapper(ctx, error):
-    """
-    A synchronous wrapper for play_next to be used in the 'after' lambda.
-    This is needed because 'after' expects a synchronous function,
-    but play_next is async. We schedule play_next to run in the bot's event loop.
+    async def _fill(self):
+        guild_id = self.guild.id
+        priority = PRIORITY_PLAY_NOW if self.waiting else PRIORITY_BULK
+        failures = 0
+        try:
+            while len(self.ready) < RADIO_PREFETCH and failures < RADIO_PREFETCH:
+                if not self.candidates and not await self._find_candidates(priority):
+                    break
+                entry = self.candidates.popleft()
+                song_item = make_unresolved_song_item(entry, bot.user)
+                song_item['requester'] = 'Autoplay'
+                video_id = song_video_id(song_item)
+                queued_ids = {song_video_id(item) for item in itertools.chain(song_queues.get(guild_id) or [], self.ready)}
+                if not video_id or video_id in self.seen or video_id in queued_ids:
+                    continue
+                if not await resolve_song_item(song_item, priority=priority, guild_id=guild_id):
+                    failures += 1
+                elif self.waiting:
+                    self._deliver(song_item)
+                    priority = PRIORITY_BULK # The rest are only resolved ahead of time
+                else:
+                    self.ready.append(song_item)
+        except ResolverSaturated:
+            pass # Tried again when the next song starts
+        except Exception as e:
+            print(f"Autoplay error in guild {guild_id}: {e}")
+        if self.waiting: # The queue ran dry and no related song could be found
+            self.waiting = False
+            player = guild_players.get(guild_id)
+            if player and player.state == 'idle' and player.channel:
+                await player.channel.send("Queue finished. Autoplay found no related songs to play.")
+
+    async def _find_candidates(self, priority):
+        """Reads the mix of the most recently played song whose mix wasn't used yet. Returns True if it had new songs."""
+        recent = list(self.history)[-RADIO_SEED_SONGS:]
+        seeds = [video_id for video_id in reversed(recent) if video_id not in self.seeded]
+        if not seeds:
+            return False
+        seed = seeds[0]
+        playlist = await resolver.submit(_open_playlist, f"https://www.youtube.com/watch?v={seed}&list=RD{seed}",
+                                         priority=priority, guild_id=self.guild.id)
+        page = []
+        if playlist:
+            _, entries, identity = playlist
+            try:
+                page, _ = await resolver.submit(_next_playlist_page, entries, identity, RADIO_MIX_SIZE, priority=priority, guild_id=self.guild.id)
+            finally:
+                await asyncio.to_thread(close_playlist, entries) # Only the first page is used
+        # Only marked once read, so a fill cancelled halfway (see fill) doesn't lose the mix
+        self.seeded.add(seed)
+        if len(self.seeded) > RADIO_HISTORY_SIZE:
+            self.seeded = {seed}
+        self.candidates.extend(entry for entry in page if song_video_id(entry) not in self.seen)
+        return bool(self.candidates)
+
+guild_radios = {} # Guild ID: GuildRadio, only while autoplay is on
+
+# Idle reclamation
+# Per-guild state only lives while a guild is actually using the bot. A reaper
+# task disconnects from channels that have been idle or empty for too long and
+# drops everything the guild held, so memory stays bounded by active guilds.
+IDLE_DISCONNECT_SECONDS = float(os.getenv('IDLE_DISCONNECT_SECONDS', '300')) # Idle/empty time before the bot leaves
+REAPER_INTERVAL_SECONDS = 30
+guild_idle_since = {} # Guild ID: time.monotonic() when the guild was first seen idle
+guild_last_active = {} # Guild ID: time.monotonic() of the guild's last command or enqueue
+orphan_ffmpeg_candidates = set() # PIDs of unowned ffmpeg children seen on the previous reaper pass
+
+def listeners_in(channel):
+    """Members of a voice channel that aren't bots."""
+    return [member for member in channel.members if not member.bot]
+
+def is_guild_idle(guild):
+    """A guild is idle when the bot isn't connected, is alone, or isn't playing anything."""
+    voice_client = guild.voice_client
+    if not voice_client or not voice_client.is_connected():
+        return True
+    if not listeners_in(voice_client.channel):
+        return True
+    return not (voice_client.is_playing() or voice_client.is_paused())
+
+def mark_guild_active(guild_id):
+    """Restarts the guild's idle clock, e.g. for a !play that is still being looked up."""
+    guild_last_active[guild_id] = time.monotonic()
+    guild_idle_since.pop(guild_id, None)
+
+def idle_for(guild_id, now):
+    """How long the guild has been idle: since it was first seen idle, or since its last activity if that's later."""
+    return now - max(guild_idle_since.get(guild_id, now), guild_last_active.get(guild_id, 0.0))
+
+def guild_state_ids():
+    """Every guild ID that currently holds per-guild state."""
+    return (set(song_queues) | set(current_song_info) | set(guild_audio_sources) | set(active_control_messages)
+            | set(guild_loop_states) | set(guild_audio_filters) | set(guild_players) | set(guild_idle_since)
+            | set(guild_last_active) | set(playlist_ingestions) | set(guild_radios))
+
+def drop_playback_state(guild_id):
+    """Forgets what the guild was playing and had queued and kills its ffmpeg process, if any.
+    Its settings (loop mode, audio filters, autoplay) are kept."""
+    audio_source = guild_audio_sources.pop(guild_id, None)
+    if audio_source:
+        audio_source.cleanup() # Kills the ffmpeg child if the audio thread didn't already
+    song_queues.pop(guild_id, None)
+    current_song_info.pop(guild_id, None)
+    active_control_messages.pop(guild_id, None)
+    cancel_playlist_ingestion(guild_id)
+    radio = guild_radios.get(guild_id)
+    if radio:
+        radio.reset()
+
+def drop_guild_state(guild_id):
+    """Forgets everything kept for a guild and kills its ffmpeg process, if any."""
+    drop_playback_state(guild_id)
+    guild_loop_states.pop(guild_id, None)
+    guild_audio_filters.pop(guild_id, None)
+    guild_loudness_locks.pop(guild_id, None)
+    guild_idle_since.pop(guild_id, None)
+    guild_last_active.pop(guild_id, None)
+    guild_radios.pop(guild_id, None)
+    player = guild_players.pop(guild_id, None)
+    if player:
+        player._cancel_prefetch()
+        if not player.closed: # Otherwise we're inside its own 'reclaim', and it forwards what's left in its mailbox
+            player.close()
+
+def owned_ffmpeg_pids():
+    """PIDs of the ffmpeg processes that belong to a live audio source or to one of our own helper runs."""
+    sources = list(guild_audio_sources.values()) + [vc.source for vc in bot.voice_clients if vc.source]
+    pids = set(helper_ffmpeg_pids)
+    for source in sources:
+        while hasattr(source, 'original'): # Unwrap TrackedAudio / PCMVolumeTransformer
+            source = source.original
+        process = getattr(source, '_process', None)
+        if process:
+            pids.add(process.pid)
+    return pids
+
+def ffmpeg_children():
+    """Blocking: PIDs of the ffmpeg processes whose parent is this process. Needs /proc, so empty outside Linux."""
+    if not os.path.isdir('/proc'):
+        return set()
+    my_pid = os.getpid()
+    children = set()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            continue # Process exited while we were looking
+        # Format: pid (comm) state ppid ...; comm may itself contain spaces or parentheses
+        comm = stat[stat.find('(') + 1:stat.rfind(')')]
+        ppid = int(stat[stat.rfind(')') + 2:].split()[1])
+        if ppid == my_pid and comm == 'ffmpeg':
+            children.add(int(entry))
+    return children
+
+async def reap_orphaned_ffmpeg():
+    """Kills ffmpeg children of this process that no audio source owns anymore.
+
+    A process must be unowned on two reaper passes in a row before it's killed,
+    so a source that is being created right now is never hit.
     """
-    if error:
-        print(f'Player error in play_next_wrapper: {error}')
-        # You might want to send a message to the channel here as well
-        # e.g., asyncio.run_coroutine_threadsafe(ctx.send(f"Playback error: {error}"), bot.loop)
-    
-    # Schedule play_next to run.
-    # If there was an error, play_next might decide to skip or retry.
-    # If no error, it proceeds to the next song or announces queue end.
-
-    guild_id = ctx.guild.id # Assuming ctx.guild is available
-    loop_mode = guild_loop_states.get(guild_id, 'off')
-
-    if loop_mode == 'song' and error is None:
-        current_song = current_song_info.get(guild_id) # Get the song that just finished
-        if current_song:
-            # Ensure queue exists for the guild
-            if guild_id not in song_queues:
-                song_queues[guild_id] = []
-            # Add the just-finished song to the beginning of the queue
-            # Use .copy() to ensure modifications to the item (if any later) don't affect the original
-            song_queues[guild_id].insert(0, current_song.copy()) 
-            # No need to send a message here, play_next will play it and announce
-    
-    # elif loop_mode == 'queue' and error is None: # Placeholder for future queue loop
-    #     current_song = current_song_info.get(guild_id)
-    #     if current_song:
-    #         if guild_id not in song_queues:
-    #             song_queues[guild_id] = []
-    #         song_queues[guild_id].append(current_song.copy()) # Add to the end for queue loop
+    global orphan_ffmpeg_candidates
+    children = await asyncio.to_thread(ffmpeg_children) # Reads all of /proc, so not on the event loop
+    orphans = children - owned_ffmpeg_pids()
+    for pid in orphans & orphan_ffmpeg_candidates:
+        try:
+            os.kill(pid, 9)
+            print(f"Killed orphaned ffmpeg process {pid}.")
+        except OSError:
+            pass
+    orphan_ffmpeg_candidates = orphans - orphan_ffmpeg_candidates
+
+def reclaim_guild(guild_id, reason=None):
+    """Has the guild's player disconnect and drop its state, so it can't race a command.
+    Only posts the command: a player busy with something slow must not hold up the caller (e.g. the reaper)."""
+    guild = bot.get_guild(guild_id)
+    if guild is None: # We were removed from the guild, nobody can use this state anymore
+        drop_guild_state(guild_id)
+        return
+    player = get_player(guild)
+    if not player.reclaim_posted:
+        player.reclaim_posted = True
+        player.post('reclaim', reason=reason)
+
+async def reap_idle_guilds():
+    """One reaper pass: reclaim guilds idle for longer than IDLE_DISCONNECT_SECONDS."""
+    now = time.monotonic()
+    guild_ids = guild_state_ids() | {vc.guild.id for vc in bot.voice_clients}
+    for guild_id in guild_ids:
+        guild = bot.get_guild(guild_id)
+        if guild is not None and not is_guild_idle(guild):
+            guild_idle_since.pop(guild_id, None)
+            continue
+        guild_idle_since.setdefault(guild_id, now)
+        if idle_for(guild_id, now) >= IDLE_DISCONNECT_SECONDS:
+            minutes = max(1, int(IDLE_DISCONNECT_SECONDS // 60))
+            reclaim_guild(guild_id, reason=f"Left the voice channel after {minutes} minute(s) of inactivity.")
+    await reap_orphaned_ffmpeg()
+    prune_rate_limiters()
+
+async def idle_reaper():
+    """Background task running reap_idle_guilds forever."""
+    while True:
+        await asyncio.sleep(REAPER_INTERVAL_SECONDS)
+        try:
+            await reap_idle_guilds()
+        except Exception as e:
+            print(f"Idle reaper error: {e}")
 
-    asyncio.run_coroutine_threadsafe(play_next(ctx), bot.loop)
+@bot.event
+async def on_voice_state_update(member, before, after):
+    guild = member.guild
+    if member.id == bot.user.id:
+        if before.channel and after.channel is None:
+            # Disconnected (!leave, !stop, kicked or channel deleted): the playback doesn't survive that, but the
+            # guild's settings do. The reaper drops those too once the guild stays idle.
+            player = guild_players.get(guild.id) # None if it left through a reclaim, which dropped everything already
+            if player:
+                player.post('disconnected')
+        return
 
+    voice_client = guild.voice_client
+    if not voice_client or not voice_client.channel:
+        return
+    if voice_client.channel in (before.channel, after.channel):
+        # Someone joined or left our channel. Start (or stop) the idle clock when it becomes empty (or not).
+        if listeners_in(voice_client.channel):
+            guild_idle_since.pop(guild.id, None)
+        else:
+            guild_idle_since.setdefault(guild.id, time.monotonic())
+
+@bot.event
+async def on_command(ctx):
+    if ctx.guild:
+        mark_guild_active(ctx.guild.id)
+
+@bot.event
+async def on_guild_remove(guild):
+    drop_guild_state(guild.id)
 
 @bot.command(name="ping")
 async def ping(ctx):
@@ -280,7 +1048,7 @@ YDL_OPTS = {
     'quiet': False, # Set to False if verbose is True, otherwise verbose messages might be suppressed
     'verbose': True, # For more detailed output from yt-dlp for debugging
     'source_address': '0.0.0.0', # Helps in some network configurations
-    'cookiefile': os.getenv('YOUTUBE_COOKIE_FILE', None), 
+    # 'cookiefile' is set per request by the identity pool (see Extraction identities)
     'extract_flat': False,
     'noplaylist': True, # Ensure we only process one item for direct yt-dlp calls unless it's a playlist *search*
     # 'outtmpl': '%(extractor)s-%(id)s-%(title)s.%(ext)s',
@@ -303,73 +1071,1047 @@ FFMPEG_OPTS = {
     'options': '-vn',
 }
 
+def ffmpeg_before_options(song_item):
+    """FFMPEG_OPTS' input options for a song. Local files are read directly, so they get no HTTP reconnect options."""
+    return '' if song_item.get('source_type') == 'local' else FFMPEG_OPTS['before_options']
+
+# Extraction identities
+# Every cookie file is an identity yt-dlp can make requests as. Lookups are
+# spread over them, and an identity that gets
+# throttled (HTTP 429, "sign in to confirm you're not a bot") is backed off
+# exponentially while the others take its load. A lookup that was throttled
+# is retried right away as another identity.
+YOUTUBE_COOKIE_FILES = [path.strip() for path in os.getenv('YOUTUBE_COOKIE_FILES', os.getenv('YOUTUBE_COOKIE_FILE') or '').split(',') if path.strip()]
+IDENTITY_BACKOFF_SECONDS = float(os.getenv('IDENTITY_BACKOFF_SECONDS', '60')) # First back-off; doubles while throttling continues
+IDENTITY_MAX_BACKOFF_SECONDS = 1800
+THROTTLE_ERROR_MARKERS = ('http error 429', 'too many requests', 'sign in to confirm', 'not a bot', 'rate-limit', 'rate limit') # Lowercase
+
+class ExtractionIdentity:
+    """A cookie file yt-dlp requests are made with, with its health and metrics."""
+
+    def __init__(self, cookiefile):
+        self.cookiefile = cookiefile
+        self.name = os.path.basename(cookiefile) if cookiefile else 'no cookies'
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.backoff = 0.0 # Current back-off length, 0 while healthy
+        self.backoff_until = 0.0 # monotonic time the identity may be used again
+        self.requests = 0
+        self.errors = 0
+        self.throttles = 0
+        self.latencies = collections.deque(maxlen=100)
+
+    def ydl_options(self, ydl_opts):
+        """A copy of ydl_opts that makes requests as this identity."""
+        options = dict(ydl_opts)
+        if self.cookiefile:
+            options['cookiefile'] = self.cookiefile
+        return options
+
+    def available(self, now):
+        return now >= self.backoff_until
+
+class IdentityPool:
+    """Picks the identity for each yt-dlp request. Used from resolver threads, hence the lock."""
+
+    def __init__(self, identities):
+        self.identities = identities
+        self.lock = threading.Lock()
+
+    def acquire(self, exclude=()):
+        """The identity to use next: the least busy, least recently used healthy one. If all are
+        backing off, the one that recovers first. Identities in exclude are only used if nothing else is left."""
+        with self.lock:
+            now = time.monotonic()
+            candidates = [identity for identity in self.identities if identity not in exclude] or self.identities
+            healthy = [identity for identity in candidates if identity.available(now)]
+            if healthy:
+                identity = min(healthy, key=lambda identity: (identity.in_flight, identity.last_used))
+            else:
+                identity = min(candidates, key=lambda identity: identity.backoff_until)
+            identity.in_flight += 1
+            identity.last_used = now
+            return identity
+
+    def use(self, identity):
+        """Like acquire, for a request that has to be made as a given identity (e.g. the later pages of a playlist)."""
+        with self.lock:
+            identity.in_flight += 1
+            identity.last_used = time.monotonic()
+
+    def release(self, identity, elapsed, error=None):
+        """Records a finished request. Returns True if error shows the identity is being throttled."""
+        throttled = error is not None and any(marker in str(error).lower() for marker in THROTTLE_ERROR_MARKERS)
+        with self.lock:
+            identity.in_flight -= 1
+            identity.requests += 1
+            identity.latencies.append(elapsed)
+            if error is not None:
+                identity.errors += 1
+            if throttled:
+                identity.throttles += 1
+                identity.backoff = min(IDENTITY_MAX_BACKOFF_SECONDS, identity.backoff * 2 or IDENTITY_BACKOFF_SECONDS)
+                identity.backoff_until = time.monotonic() + identity.backoff
+            elif error is None:
+                identity.backoff = 0.0
+        if throttled:
+            print(f"yt-dlp identity '{identity.name}' is throttled, backing off for {identity.backoff:.0f}s: {error}")
+        return throttled
+
+    def snapshot(self):
+        """Per identity: name, state, requests, errors, throttles and p50/p95 latency."""
+        now = time.monotonic()
+        rows = []
+        with self.lock:
+            for identity in self.identities:
+                latencies = sorted(identity.latencies)
+                rows.append({
+                    'name': identity.name,
+                    'backing_off': 0 if identity.available(now) else identity.backoff_until - now,
+                    'requests': identity.requests,
+                    'errors': identity.errors,
+                    'throttles': identity.throttles,
+                    'p50_latency': latencies[len(latencies) // 2] if latencies else 0.0,
+                    'p95_latency': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] if latencies else 0.0,
+                })
+        return rows
+
+identity_pool = IdentityPool([ExtractionIdentity(cookiefile) for cookiefile in YOUTUBE_COOKIE_FILES or [None]])
+
+def extract_info_as_identity(ydl_opts, query, **kwargs):
+    """ydl.extract_info(query) made as a pool identity. Throttled requests are retried as the other identities."""
+    yt_dlp = get_yt_dlp()
+    tried = set()
+    while True:
+        identity = identity_pool.acquire(exclude=tried)
+        tried.add(identity)
+        started = time.monotonic()
+        try:
+            with yt_dlp.YoutubeDL(identity.ydl_options(ydl_opts)) as ydl:
+                info = ydl.extract_info(query, download=False, **kwargs)
+        except Exception as e:
+            throttled = identity_pool.release(identity, time.monotonic() - started, e)
+            if throttled and len(tried) < len(identity_pool.identities):
+                continue
+            raise
+        identity_pool.release(identity, time.monotonic() - started)
+        return info
+
+# Audio filters
+# Bass boost, nightcore and loudness normalization are ffmpeg filters (-af),
+# so all the DSP happens inside ffmpeg and Python only ever passes frames on.
+BASS_BOOST_LEVELS = {'off': 0, 'low': 5, 'medium': 10, 'high': 15} # Gain in dB
+NIGHTCORE_SPEED = 1.25
+LOUDNESS_TARGET_LUFS = -16.0
+LOUDNESS_CACHE_SIZE = 4096
+LOUDNESS_SAMPLE_SECONDS = 30 # Measured from the middle of the song; decoding all of it would double every song's cost
+LOUDNESS_TIMEOUT_SECONDS = 60
+LOUDNESS_MAX_CONCURRENT = int(os.getenv('LOUDNESS_MAX_CONCURRENT', '4')) # Measurements running at once, over all guilds
+guild_audio_filters = {} # Guild ID: {'bassboost': dB, 'nightcore': bool, 'normalize': bool}
+loudness_cache = collections.OrderedDict() # loudness_key: measured integrated loudness in LUFS
+loudness_measurements = {} # loudness_key: asyncio.Task measuring it
+helper_ffmpeg_pids = set() # ffmpeg processes we run ourselves (loudness measurements), so the reaper leaves them alone
+loudness_semaphore = None # Created on first use; bounds measurements over all guilds
+guild_loudness_locks = {} # Guild ID: asyncio.Lock, so one guild measures one song at a time and can't take every slot
+
+def loudness_key(song_item):
+    """What a song's loudness is cached under: its page URL, or its path for local files."""
+    return song_item.get('webpage_url') or song_item.get('stream_url')
+
+def get_audio_filters(guild_id):
+    return guild_audio_filters.get(guild_id, {'bassboost': 0, 'nightcore': False, 'normalize': False})
+
+def playback_speed(guild_id):
+    """How many seconds of the track one second of playback covers with the guild's filters."""
+    return NIGHTCORE_SPEED if get_audio_filters(guild_id)['nightcore'] else 1.0
+
+def build_audio_filter(guild_id, song_item):
+    """The ffmpeg -af chain for a song with the guild's filters, or None if no filter is on."""
+    filters = get_audio_filters(guild_id)
+    chain = []
+    if filters['nightcore']:
+        # Resample first so asetrate's speed-up is exact whatever the source's sample rate
+        chain.append(f"aresample=48000,asetrate={int(48000 * NIGHTCORE_SPEED)},aresample=48000") # Faster and higher pitched
+    if filters['bassboost']:
+        chain.append(f"bass=g={filters['bassboost']}:f=110:w=0.6")
+    if filters['normalize']:
+        measured = loudness_cache.get(loudness_key(song_item))
+        if measured is not None:
+            # Known loudness: a plain gain is enough, so normalizing costs a single cheap pass
+            chain.append(f"volume={LOUDNESS_TARGET_LUFS - measured:.1f}dB")
+        else:
+            chain.append("dynaudnorm=f=150:g=15") # Not measured yet: adaptive normalization
+    if filters['bassboost'] or filters['normalize']:
+        chain.append("alimiter=limit=0.97") # Boosted audio must not clip
+    return ",".join(chain) or None
+
+def build_ffmpeg_options(song_item, guild_id, start_at=0):
+    """FFMPEG_OPTS for a song, with the guild's filter chain and an optional start position in seconds."""
+    before_options = ffmpeg_before_options(song_item)
+    if start_at > 0:
+        before_options += f" -ss {start_at:.2f}"
+    options = FFMPEG_OPTS['options']
+    audio_filter = build_audio_filter(guild_id, song_item)
+    if audio_filter:
+        options += f' -af "{audio_filter}"'
+    return {'before_options': before_options, 'options': options}
+
+async def measure_loudness(song_item, guild_id):
+    """Measures a song's integrated loudness with ffmpeg and caches it for build_audio_filter.
+
+    Only LOUDNESS_SAMPLE_SECONDS from the middle of the song are decoded,
+    which is close enough for a gain and keeps the extra download small.
+    """
+    global loudness_semaphore
+    key = loudness_key(song_item)
+    if not key or not song_item.get('stream_url') or key in loudness_cache or key in loudness_measurements:
+        return
+    loudness_measurements[key] = asyncio.current_task()
+    if loudness_semaphore is None:
+        loudness_semaphore = asyncio.Semaphore(LOUDNESS_MAX_CONCURRENT)
+    duration = song_item.get('duration') or 0
+    sample_start = max(0, (duration - LOUDNESS_SAMPLE_SECONDS) // 2)
+    try:
+        async with guild_loudness_locks.setdefault(guild_id, asyncio.Lock()), loudness_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                'ffmpeg', '-hide_banner', '-nostats', *ffmpeg_before_options(song_item).split(),
+                '-ss', str(sample_start), '-t', str(LOUDNESS_SAMPLE_SECONDS),
+                '-i', song_item['stream_url'], '-vn', '-af', 'loudnorm=print_format=json', '-f', 'null', '-',
+                stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            helper_ffmpeg_pids.add(process.pid)
+            try:
+                _, stderr = await asyncio.wait_for(process.communicate(), LOUDNESS_TIMEOUT_SECONDS)
+            finally:
+                helper_ffmpeg_pids.discard(process.pid)
+                if process.returncode is None:
+                    process.kill()
+        match = re.search(r'"input_i"\s*:\s*"(-?[\d.]+)"', stderr.decode(errors='ignore'))
+        if match:
+            loudness_cache[key] = float(match.group(1))
+            while len(loudness_cache) > LOUDNESS_CACHE_SIZE:
+                loudness_cache.popitem(last=False)
+    except Exception as e:
+        print(f"Loudness measurement failed for {key}: {e}")
+    finally:
+        loudness_measurements.pop(key, None)
+
+# Format selection
+# Discord sends Opus, so an Opus (WebM) stream at or below the channel's
+# bitrate is the cheapest thing to fetch: with no filters and full volume it
+# is passed straight through without decoding, otherwise it is at least
+# never bigger than what the channel can carry.
+stream_stats = {'passthrough': 0, 'transcoded': 0} # Sources started per mode, for !stats
+
+def channel_bitrate_kbps(guild):
+    """Bitrate of the guild's voice channel in kbps, or None if not connected."""
+    voice_client = guild.voice_client if guild else None
+    if not voice_client or not voice_client.channel:
+        return None
+    return voice_client.channel.bitrate // 1000
+
+def audio_format_for(max_kbps):
+    """yt-dlp format selector preferring Opus audio at or below max_kbps, falling back step by step."""
+    if not max_kbps:
+        return 'bestaudio[acodec=opus]/bestaudio/best'
+    return (f"bestaudio[acodec=opus][abr<=?{max_kbps}]/bestaudio[acodec=opus]/"
+            f"bestaudio[abr<=?{max_kbps}]/bestaudio/best")
+
+def can_pass_through(song_item, guild_id, volume=1.0):
+    """True if ffmpeg can copy the song's Opus packets as they are: no filters and nothing to scale."""
+    return song_item.get('acodec') == 'opus' and volume == 1.0 and build_audio_filter(guild_id, song_item) is None
+
+def create_ffmpeg_source(song_item, guild_id, start_at=0, volume=1.0):
+    """Starts ffmpeg for a song: Opus pass-through when possible, PCM with volume control otherwise."""
+    ffmpeg_options = build_ffmpeg_options(song_item, guild_id, start_at=start_at)
+    if can_pass_through(song_item, guild_id, volume):
+        stream_stats['passthrough'] += 1
+        return discord.FFmpegOpusAudio(song_item['stream_url'], codec='copy', **ffmpeg_options)
+    stream_stats['transcoded'] += 1
+    return discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(song_item['stream_url'], **ffmpeg_options), volume=volume)
+
+class TrackedAudio(discord.AudioSource):
+    """The audio source of the song playing in a guild.
+
+    Knows the playback position, owns the volume, and can swap its ffmpeg
+    process in place (to seek, change filters, or switch between Opus
+    pass-through and PCM). Swapping here rather than through
+    voice_client.source means the audio thread never sees the old process
+    end: a read cut short by the swap simply continues from the new source.
+    """
+
+    def __init__(self, original, volume=1.0, start_at=0.0, speed=1.0):
+        self.original = original # Opus (pass-through) or PCMVolumeTransformer source
+        self._volume = volume
+        self.start_at = start_at # Track position (seconds) the current ffmpeg process started at
+        self.speed = speed # Track seconds per second of playback
+        self.frames = 0 # 20ms frames read from the current ffmpeg process
+        self.delivered = 0 # 20ms frames read over the source's whole life, for the stall watchdog
+        self.watch_since = time.monotonic() # Start of the watchdog's current observation window
+        self.watch_delivered = 0 # self.delivered at watch_since
+        self.recovering = False # A stall was reported and the player hasn't rebuilt the source yet
+        self.recoveries = 0 # Stall recoveries for this song
+        # Reported until the first read. VoiceClient.play only creates an Opus encoder for
+        # non-Opus sources, and we need one in case we switch to PCM later.
+        self._last_is_opus = False
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+        if isinstance(self.original, discord.PCMVolumeTransformer):
+            self.original.volume = self._volume
+
+    @property
+    def passthrough(self):
+        return self.original.is_opus()
+
+    @property
+    def position(self):
+        """Current position in the track, in seconds."""
+        return self.start_at + self.frames * 0.02 * self.speed
+
+    def is_opus(self):
+        # Must describe the packet read() returned last, even if the source was swapped since
+        return self._last_is_opus
+
+    def read(self):
+        original = self.original
+        data = original.read()
+        if not data and self.original is not original:
+            original = self.original
+            data = original.read() # Swapped while we were reading: continue from the new process
+        self._last_is_opus = original.is_opus()
+        if data:
+            self.frames += 1
+            self.delivered += 1
+        return data
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    def replace_original(self, original, start_at, speed):
+        """Continues playback from a new ffmpeg source starting at start_at, and kills the old one."""
+        if isinstance(original, discord.PCMVolumeTransformer):
+            original.volume = self._volume
+        old = self.original
+        self.start_at = start_at
+        self.speed = speed
+        self.frames = 0
+        self.reset_watch()
+        self.original = original
+        old.cleanup()
+
+    def reset_watch(self, now=None):
+        """Starts a new stall watchdog observation window."""
+        self.watch_since = now if now is not None else time.monotonic()
+        self.watch_delivered = self.delivered
+
+
+# Stall watchdog
+# A stream can stall without closing (-reconnect doesn't help then): ffmpeg
+# just stops producing audio and the guild goes quiet. The watchdog compares
+# how many frames each playing source delivered with how many real time
+# needs, and has the player rebuild a stalled source at the same position
+# from a freshly resolved stream URL.
+STALL_TIMEOUT_SECONDS = float(os.getenv('STALL_TIMEOUT_SECONDS', '5')) # Observation window; a stall is detected within about this long
+STALL_STARTUP_GRACE_SECONDS = 15 # A new ffmpeg process may take this long to deliver its first frame
+STALL_MIN_DELIVERY_RATIO = 0.25 # Share of real time a window must deliver to not count as stalled
+STALL_CHECK_INTERVAL_SECONDS = 1
+STALL_MAX_RECOVERIES = 3 # Recoveries per song before it's skipped instead
+stream_health = {'stalls': 0, 'recoveries': 0, 'failed_recoveries': 0} # For !stats
+
+def check_for_stall(audio_source, voice_client, now):
+    """True if audio_source delivered too few frames over its current observation window. Starts a new window when one ends."""
+    if audio_source.recovering:
+        return False
+    if not voice_client.is_connected() or not voice_client.is_playing(): # Paused, or waiting to reconnect to voice
+        audio_source.reset_watch(now)
+        return False
+    elapsed = now - audio_source.watch_since
+    window = STALL_STARTUP_GRACE_SECONDS if audio_source.frames == 0 else STALL_TIMEOUT_SECONDS
+    if elapsed < window:
+        return False
+    delivered = audio_source.delivered - audio_source.watch_delivered
+    audio_source.reset_watch(now)
+    return delivered < elapsed / 0.02 * STALL_MIN_DELIVERY_RATIO
+
+async def stream_watchdog():
+    while True:
+        await asyncio.sleep(STALL_CHECK_INTERVAL_SECONDS)
+        now = time.monotonic()
+        for guild_id, audio_source in list(guild_audio_sources.items()):
+            guild = bot.get_guild(guild_id)
+            voice_client = guild.voice_client if guild else None
+            if not voice_client or voice_client.source is not audio_source:
+                continue
+            if check_for_stall(audio_source, voice_client, now):
+                stream_health['stalls'] += 1
+                audio_source.recovering = True
+                print(f"Stream stalled in guild {guild_id} at {format_duration(int(audio_source.position))}, recovering.")
+                get_player(guild).post('recover', audio_source=audio_source)
+
+# Resolver
+# yt-dlp extraction is blocking and slow, so it runs on a small thread pool.
+# Requests are served by priority class first, and round-robin between guilds
+# within a class, so one guild's bulk playlist work never delays another
+# guild's !play. When too much is pending, low priority work is shed first.
+PRIORITY_PLAY_NOW = 0 # Will play as soon as it resolves (nothing playing / next up)
+PRIORITY_INTERACTIVE = 1 # A user is waiting on the answer
+PRIORITY_BULK = 2 # Background work, e.g. the rest of a playlist
+PRIORITY_NAMES = {PRIORITY_PLAY_NOW: 'play-now', PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BULK: 'bulk'}
+
+RESOLVER_WORKERS = int(os.getenv('RESOLVER_WORKERS', '4'))
+RESOLVER_MAX_PENDING = int(os.getenv('RESOLVER_MAX_PENDING', '200')) # Pending requests (all classes) before shedding
+
+# Hedging: if a full extraction is slower than most recent ones, a second attempt
+# with a different yt-dlp client is started and whichever succeeds first wins.
+RESOLVER_HEDGING = os.getenv('RESOLVER_HEDGING', 'off').lower() in ('1', 'true', 'yes', 'on')
+RESOLVER_HEDGE_PERCENTILE = float(os.getenv('RESOLVER_HEDGE_PERCENTILE', '0.9')) # Hedge requests slower than this share of recent ones
+RESOLVER_HEDGE_MIN_DELAY = float(os.getenv('RESOLVER_HEDGE_MIN_DELAY', '1.5')) # Never hedge earlier than this (seconds)
+RESOLVER_HEDGE_DEFAULT_DELAY = 3.0 # Used until enough latencies have been seen
+RESOLVER_HEDGE_MIN_SAMPLES = 20
+RESOLVER_HEDGE_PLAYER_CLIENTS = os.getenv('RESOLVER_HEDGE_PLAYER_CLIENTS', 'ios,tv').split(',') # yt-dlp YouTube clients for the hedge
+
+class ResolverSaturated(Exception):
+    """Raised for a resolver request that was shed because the resolver is full."""
+
+class Resolver:
+    """Priority, per-guild fair scheduler in front of a thread pool for blocking lookups."""
+
+    def __init__(self, workers, max_pending, hedging=False):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.hedging = hedging
+        self.hedge_latencies = collections.deque(maxlen=200) # Recent run times of hedgeable jobs, sets the hedge deadline
+        self.hedges_launched = 0
+        self.hedges_won = 0 # Hedge finished first with a usable result
+        self.pending = {priority: collections.OrderedDict() for priority in PRIORITY_NAMES} # Priority: {guild ID: deque of jobs}
+        self.depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self.stats = {priority: {'submitted': 0, 'completed': 0, 'shed': 0, 'waits': collections.deque(maxlen=200),
+                                 'latencies': collections.deque(maxlen=200)}
+                      for priority in PRIORITY_NAMES}
+        self.executor = None
+        self.hedge_executor = None # Separate pool so hedges never take a worker from queued requests
+        self.ready = None # Semaphore counting queued jobs; created on first use so it binds to the running loop
+
+    def _start(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='resolver')
+        self.hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='resolver-hedge')
+        self.ready = asyncio.Semaphore(0)
+        for _ in range(self.workers):
+            spawn_background(self._worker())
+
+    async def submit(self, func, *args, priority=PRIORITY_INTERACTIVE, guild_id=None, hedge=None, user_id=None):
+        """Runs func(*args) on the pool and returns its result. Raises ResolverSaturated if shed.
+
+        hedge is an optional (func, args) alternative that may be raced against
+        the request when it is slow; see _run_hedged. Requests made on behalf of
+        user_id count against the user's and the guild's lookup limits, and
+        raise RateLimited right away when those are used up.
+        """
+        if self.ready is None:
+            self._start()
+        if user_id is not None:
+            wait = admit((user_lookup_limiter, user_id), (guild_lookup_limiter, guild_id))
+            if wait:
+                admission_stats['lookups_limited'] += 1
+                raise RateLimited(f"Too many songs were looked up recently. Please try again in {math.ceil(wait)}s.")
+        if sum(self.depth.values()) >= self.max_pending and not self._shed_below(priority):
+            self.stats[priority]['shed'] += 1
+            raise ResolverSaturated(f"Resolver is saturated ({self.max_pending} requests pending).")
+
+        job = {'func': func, 'args': args, 'future': asyncio.get_running_loop().create_future(),
+               'priority': priority, 'guild_id': guild_id, 'enqueued': time.monotonic(), 'hedge': hedge}
+        self.pending[priority].setdefault(guild_id, collections.deque()).append(job)
+        self.depth[priority] += 1
+        self.stats[priority]['submitted'] += 1
+        self.ready.release()
+        return await job['future']
+
+    def _shed_below(self, priority):
+        """Drops the newest job of the busiest guild in the lowest class below priority. Returns True if one was dropped."""
+        for lower in sorted(self.pending, reverse=True):
+            if lower <= priority:
+                break
+            guilds = self.pending[lower]
+            if not guilds:
+                continue
+            guild_id = max(guilds, key=lambda g: len(guilds[g]))
+            job = guilds[guild_id].pop()
+            if not guilds[guild_id]:
+                del guilds[guild_id]
+            self.depth[lower] -= 1
+            self.stats[lower]['shed'] += 1
+            if not job['future'].done():
+                job['future'].set_exception(ResolverSaturated("Dropped to make room for a higher priority request."))
+            return True
+        return False
+
+    def _pop(self):
+        """Next job: highest priority class first, guilds in round-robin order within it."""
+        for priority in sorted(self.pending):
+            guilds = self.pending[priority]
+            if not guilds:
+                continue
+            guild_id, jobs = next(iter(guilds.items()))
+            job = jobs.popleft()
+            if jobs:
+                guilds.move_to_end(guild_id) # This guild goes to the back of the line
+            else:
+                del guilds[guild_id]
+            self.depth[priority] -= 1
+            return job
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.ready.acquire()
+            job = self._pop()
+            if job is None or job['future'].done():
+                continue # Shed, or the caller went away
+            stats = self.stats[job['priority']]
+            started = time.monotonic()
+            stats['waits'].append(started - job['enqueued'])
+            try:
+                if job['hedge'] and self.hedging:
+                    result = await self._run_hedged(job)
+                else:
+                    result = await loop.run_in_executor(self.executor, job['func'], *job['args'])
+            except Exception as e:
+                if not job['future'].done():
+                    job['future'].set_exception(e)
+            else:
+                if not job['future'].done():
+                    job['future'].set_result(result)
+            stats['completed'] += 1
+            stats['latencies'].append(job.get('answered', time.monotonic()) - started)
+
+    def hedge_delay(self):
+        """How long a hedgeable job may run before it is hedged: a percentile of recent run times."""
+        if len(self.hedge_latencies) < RESOLVER_HEDGE_MIN_SAMPLES:
+            return RESOLVER_HEDGE_DEFAULT_DELAY
+        latencies = sorted(self.hedge_latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * RESOLVER_HEDGE_PERCENTILE))
+        return max(RESOLVER_HEDGE_MIN_DELAY, latencies[index])
+
+    def _timed(self, func, args):
+        """Runs on a worker thread: calls func and records how long it took, even if it loses a hedge race."""
+        started = time.monotonic()
+        try:
+            return func(*args)
+        finally:
+            self.hedge_latencies.append(time.monotonic() - started)
+
+    async def _run_hedged(self, job):
+        """Runs a job and, if it outlives hedge_delay(), races it against its hedge.
+
+        The first attempt to return a usable (truthy) result wins and the other
+        is cancelled. A thread that's already running can't be interrupted, so
+        a loser that already started finishes in the background and its result
+        is thrown away. When the hedge wins, the caller gets its result right
+        away, but this worker waits for the primary to free its executor thread
+        before it takes the next job; otherwise that job would queue inside the
+        executor, first come first served, past the priorities and fairness.
+        """
+        loop = asyncio.get_running_loop()
+        primary = loop.run_in_executor(self.executor, self._timed, job['func'], job['args'])
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_delay())
+        if done:
+            return primary.result()
+
+        self.hedges_launched += 1
+        hedge_func, hedge_args = job['hedge']
+        hedge = loop.run_in_executor(self.hedge_executor, hedge_func, *hedge_args)
+        attempts = {primary, hedge}
+        error = None
+        while attempts:
+            done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception() is not None:
+                    error = attempt.exception()
+                elif attempt.result():
+                    if attempt is hedge:
+                        self.hedges_won += 1
+                        if attempts: # The primary is still running
+                            job['answered'] = time.monotonic()
+                            if not job['future'].done():
+                                job['future'].set_result(attempt.result())
+                            await asyncio.gather(primary, return_exceptions=True)
+                    else:
+                        hedge.cancel()
+                    return attempt.result()
+        if error:
+            raise error
+        return None
+
+    def snapshot(self):
+        """Per-class queue depth and wait times, for !stats."""
+        report = {}
+        for priority, name in PRIORITY_NAMES.items():
+            stats = self.stats[priority]
+            waits = sorted(stats['waits'])
+            latencies = sorted(stats['latencies'])
+            report[name] = {
+                'depth': self.depth[priority],
+                'submitted': stats['submitted'],
+                'completed': stats['completed'],
+                'shed': stats['shed'],
+                'avg_wait': sum(waits) / len(waits) if waits else 0.0,
+                'p95_wait': waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                'p99_latency': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0,
+            }
+        return report
+
+    def hedge_snapshot(self):
+        """Hedging counters, for !stats."""
+        return {
+            'enabled': self.hedging,
+            'launched': self.hedges_launched,
+            'won': self.hedges_won,
+            'delay': self.hedge_delay(),
+        }
+
+resolver = Resolver(RESOLVER_WORKERS, RESOLVER_MAX_PENDING, hedging=RESOLVER_HEDGING)
+
+# Admission control
+# Token buckets per user and per guild limit how often !play can be used and
+# how many lookups a user's requests may cause, so a single user (or server)
+# can't use up the resolver or get the bot rate limited by YouTube. The queue
+# itself is capped in length, and no requester may hold more than a share of
+# it. Anything over a limit is refused immediately instead of waiting.
+PLAY_PER_MINUTE_USER = float(os.getenv('PLAY_PER_MINUTE_USER', '10'))
+PLAY_BURST_USER = int(os.getenv('PLAY_BURST_USER', '5'))
+PLAY_PER_MINUTE_GUILD = float(os.getenv('PLAY_PER_MINUTE_GUILD', '30'))
+PLAY_BURST_GUILD = int(os.getenv('PLAY_BURST_GUILD', '15'))
+LOOKUPS_PER_MINUTE_USER = float(os.getenv('LOOKUPS_PER_MINUTE_USER', '30'))
+LOOKUPS_BURST_USER = int(os.getenv('LOOKUPS_BURST_USER', '30'))
+LOOKUPS_PER_MINUTE_GUILD = float(os.getenv('LOOKUPS_PER_MINUTE_GUILD', '120'))
+LOOKUPS_BURST_GUILD = int(os.getenv('LOOKUPS_BURST_GUILD', '90'))
+MAX_QUEUE_LENGTH = int(os.getenv('MAX_QUEUE_LENGTH', '1000'))
+MAX_REQUESTER_SHARE = float(os.getenv('MAX_REQUESTER_SHARE', '0.5')) # Share of MAX_QUEUE_LENGTH one requester may fill
+
+class RateLimited(ResolverSaturated):
+    """Raised for a resolver request refused by a user's or guild's lookup limit. The message is meant for the user."""
+
+class TokenBucketLimiter:
+    """One token bucket per key (user or guild ID). A key may spend up to burst tokens at once, refilled at per_minute.
+    A limit of 0 turns the limiter off."""
+
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.buckets = {} # Key: (tokens, monotonic time they were counted)
+
+    def _tokens(self, key, now):
+        tokens, counted_at = self.buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + (now - counted_at) * self.rate)
+
+    def wait_time(self, key, now):
+        """Seconds until key has a token, 0 if it has one now."""
+        if self.rate <= 0 or self.burst <= 0:
+            return 0
+        return max(0.0, (1 - self._tokens(key, now)) / self.rate)
+
+    def take(self, key, now):
+        if self.rate > 0 and self.burst > 0:
+            self.buckets[key] = (self._tokens(key, now) - 1, now)
+
+    def prune(self):
+        """Forgets buckets that have refilled completely; they are the same as new ones."""
+        now = time.monotonic()
+        for key in [key for key in self.buckets if self._tokens(key, now) >= self.burst]:
+            del self.buckets[key]
+
+user_play_limiter = TokenBucketLimiter(PLAY_PER_MINUTE_USER, PLAY_BURST_USER)
+guild_play_limiter = TokenBucketLimiter(PLAY_PER_MINUTE_GUILD, PLAY_BURST_GUILD)
+user_lookup_limiter = TokenBucketLimiter(LOOKUPS_PER_MINUTE_USER, LOOKUPS_BURST_USER)
+guild_lookup_limiter = TokenBucketLimiter(LOOKUPS_PER_MINUTE_GUILD, LOOKUPS_BURST_GUILD)
+admission_stats = {'plays_limited': 0, 'lookups_limited': 0, 'queue_full': 0} # Refusals, for !stats
+
+def admit(*checks):
+    """Takes a token from every (limiter, key) in checks if each has one.
+    Returns 0 if admitted, otherwise the seconds until all of them would have one."""
+    now = time.monotonic()
+    wait = max(limiter.wait_time(key, now) for limiter, key in checks)
+    if not wait:
+        for limiter, key in checks:
+            limiter.take(key, now)
+    return wait
+
+async def admit_play(ctx, user):
+    """Admission control for a request to play something. Tells the user and returns False if they must wait."""
+    wait = admit((user_play_limiter, user.id), (guild_play_limiter, ctx.guild.id))
+    if wait:
+        admission_stats['plays_limited'] += 1
+        await ctx.send(f"Too many songs were requested recently. Please try again in {math.ceil(wait)}s.")
+    return not wait
+
+def queue_room(guild_id, requester_id):
+    """How many more songs requester_id may add to the guild's queue under MAX_QUEUE_LENGTH and MAX_REQUESTER_SHARE."""
+    guild_queue = song_queues.get(guild_id)
+    if guild_queue is None:
+        queue = []
+    elif guild_loop_states.get(guild_id) == 'queue':
+        queue = guild_queue.items # Played songs come around again, so they count too
+    else:
+        queue = guild_queue
+    own = sum(1 for song_item in queue if song_item.get('requester_id') == requester_id)
+    return max(0, min(MAX_QUEUE_LENGTH - len(queue), int(MAX_QUEUE_LENGTH * MAX_REQUESTER_SHARE) - own))
+
+def prune_rate_limiters():
+    for limiter in (user_play_limiter, guild_play_limiter, user_lookup_limiter, guild_lookup_limiter):
+        limiter.prune()
+
+def resolver_refusal_message(error):
+    """What to tell the user when the resolver refused a request with error."""
+    return str(error) if isinstance(error, RateLimited) else RESOLVER_BUSY_MESSAGE
+
+QUEUE_FULL_MESSAGE = "The queue is full, or you already have your share of it. Please wait for some songs to play first."
+
+class TTLCache:
+    """Small LRU cache whose entries expire after ttl seconds."""
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict() # Key: (expires_at, value)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+# Stream URLs stay valid for hours, so a fully resolved song can be reused for a while.
+RESOLVE_CACHE_SECONDS = 600
+resolved_info_cache = TTLCache(RESOLVE_CACHE_SECONDS, 512) # Query or URL: fetch_youtube_info result
+
+SEARCH_RESULTS = 15 # Results fetched per !search
+SEARCH_PAGE_SIZE = 5 # Results shown per page of the !search menu
+SEARCH_CACHE_SECONDS = 300
+search_cache = TTLCache(SEARCH_CACHE_SECONDS, 256) # (query, limit): list of flat search results
+
 # This is the new, combined play command that includes Spotify and general URL/search logic
-async def fetch_youtube_info(query_or_url: str): # Ensure this helper is defined before the play command that uses it
+async def fetch_youtube_info(query_or_url: str, priority=PRIORITY_INTERACTIVE, guild_id=None, fresh=False, user_id=None, on_miss=None): # Ensure this helper is defined before the play command that uses it
     """
-    Fetches video information from YouTube or other yt-dlp supported sites.
+    Fetches video information from YouTube or other yt-dlp supported sites through the resolver.
+    The audio format is picked for the bitrate of the guild's voice channel (see audio_format_for).
+    fresh=True skips resolved_info_cache, e.g. when a cached stream URL stopped working.
+    user_id is the user the lookup is made for (see Resolver.submit); cache hits are free.
+    on_miss, if given, is called when the cache can't answer and a full extraction is made.
     Returns a dictionary with 'title', 'stream_url', 'webpage_url', 'duration', 
-    'thumbnail_url', 'uploader', 'source_type' or None.
+    'thumbnail_url', 'uploader', 'source_type', 'acodec' or None.
+    Raises ResolverSaturated if the request was shed.
     """
+    audio_format = audio_format_for(channel_bitrate_kbps(bot.get_guild(guild_id)) if guild_id else None)
+    cache_key = (query_or_url, audio_format)
+    cached = None if fresh else resolved_info_cache.get(cache_key)
+    if cached:
+        return cached
+    if on_miss:
+        on_miss()
+    info = await resolver.submit(_extract_youtube_info, query_or_url, 'default', audio_format, priority=priority, guild_id=guild_id,
+                                 user_id=user_id, hedge=(_extract_youtube_info, (query_or_url, 'alternate', audio_format)))
+    if info:
+        resolved_info_cache.put(cache_key, info)
+    return info
+
+async def fetch_search_results(query: str, limit=SEARCH_RESULTS, priority=PRIORITY_INTERACTIVE, guild_id=None, user_id=None, on_miss=None):
+    """
+    Cheap YouTube search: a flat 'ytsearchN:' lookup that only lists the results, without extracting streams.
+    Returns a list of dicts with 'title', 'webpage_url', 'duration', 'uploader' (possibly empty).
+    Results are cached for SEARCH_CACHE_SECONDS; on_miss, if given, is called when a lookup is made.
+    Raises ResolverSaturated if the request was shed.
+    """
+    key = (query.lower(), limit)
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    if on_miss:
+        on_miss()
+    results = await resolver.submit(_extract_search_results, query, limit, priority=priority, guild_id=guild_id, user_id=user_id)
+    if results:
+        search_cache.put(key, results)
+    return results
+
+def _extract_search_results(query: str, limit: int):
+    """Blocking part of fetch_search_results. Runs on a resolver thread."""
     ydl_opts_local = YDL_OPTS.copy()
-    # For direct URL, don't want 'ytsearch:' and want to handle playlists if URL is a playlist
-    # However, for this function's current primary use (single track resolution), noplaylist=True is good.
-    # If query_or_url is a playlist URL and we want all items, this needs adjustment or a different function.
-    
+    ydl_opts_local['extract_flat'] = 'in_playlist' # List the search hits, don't resolve each of them
+    try:
+        info = extract_info_as_identity(ydl_opts_local, f"ytsearch{limit}:{query}")
+    except Exception as e:
+        print(f"fetch_search_results error: {e}")
+        return []
+
+    results = []
+    for entry in (info or {}).get('entries') or []:
+        if not entry:
+            continue
+        webpage_url = entry.get('webpage_url') or entry.get('url')
+        if not webpage_url and entry.get('id'):
+            webpage_url = f"https://www.youtube.com/watch?v={entry['id']}"
+        if not webpage_url:
+            continue
+        results.append({
+            'title': entry.get('title', 'Unknown title'),
+            'webpage_url': webpage_url,
+            'duration': entry.get('duration', 0),
+            'uploader': entry.get('uploader') or entry.get('channel') or 'Unknown Uploader',
+        })
+    return results
+
+# Playlist ingestion
+# Playlists are listed with a flat, lazy extraction: yt-dlp fetches the
+# playlist page by page while we iterate it, and each page is queued as soon
+# as it arrives. Songs are queued unresolved ('stream_url' is None) and only
+# fully extracted when they are about to play (see GuildPlayer._prefetch).
+PLAYLIST_URL_REGEX = r"https?://(www\.|music\.)?(youtube\.com/playlist\?.*list=|soundcloud\.com/[^/]+/sets/)"
+PLAYLIST_FIRST_PAGE_SIZE = 5 # Small first page so the first song starts right away
+PLAYLIST_PAGE_SIZE = 100
+PLAYLIST_MAX_ITEMS = int(os.getenv('PLAYLIST_MAX_ITEMS', '5000'))
+playlist_ingestions = {} # Guild ID: asyncio.Task streaming a playlist into the queue
+
+def _open_playlist(url: str):
+    """Blocking: starts a lazy extraction of a playlist. Returns (title, iterator over flat entries, identity) or None.
+    The later pages are fetched through the same YoutubeDL, so they have to be made as the same identity.
+    The YoutubeDL is closed once the entries run out; callers that stop early close the iterator (close_playlist).
+    """
+    yt_dlp = get_yt_dlp()
+    ydl_opts_local = YDL_OPTS.copy()
+    ydl_opts_local.update({'noplaylist': False, 'extract_flat': 'in_playlist', 'lazy_playlist': True})
+    identity = identity_pool.acquire()
+    started = time.monotonic()
+    ydl = yt_dlp.YoutubeDL(identity.ydl_options(ydl_opts_local))
+    try:
+        # process=False keeps 'entries' as the extractor's generator, so pages are only fetched as we iterate
+        info = ydl.extract_info(url, download=False, process=False)
+        if info and info.get('_type') in ('url', 'url_transparent'): # The URL redirected to the real playlist
+            info = ydl.extract_info(info['url'], download=False, process=False)
+    except Exception as e:
+        identity_pool.release(identity, time.monotonic() - started, e)
+        ydl.close()
+        print(f"Playlist extraction error: {e}")
+        return None
+    identity_pool.release(identity, time.monotonic() - started)
+    if not info or info.get('entries') is None:
+        ydl.close()
+        return None
+    entries = _playlist_entries(ydl, info['entries'])
+    next(entries) # Enters the with block, so closing the iterator always closes ydl
+    return info.get('title') or 'Unknown playlist', entries, identity
+
+def _playlist_entries(ydl, entries):
+    """The entries of a lazily extracted playlist, with ydl closed when they end. Yields None first, see _open_playlist."""
+    with ydl:
+        yield None
+        yield from entries
+
+def close_playlist(entries):
+    """Blocking: closes an _open_playlist iterator and its YoutubeDL. If a resolver thread is still reading
+    it (the ingestion was cancelled mid-page), the garbage collector closes it once that read is over."""
+    try:
+        entries.close()
+    except ValueError: # Generator already executing
+        pass
+
+def _next_playlist_page(entries, identity, page_size: int):
+    """Blocking: pulls up to page_size flat entries from an _open_playlist iterator, as the identity that opened it.
+    Returns (usable entries, exhausted). Unusable entries are skipped, so only exhausted says the playlist ended.
+    """
+    fetched = []
+    identity_pool.use(identity)
+    started = time.monotonic()
+    try:
+        fetched.extend(itertools.islice(entries, page_size)) # Fetches the next page(s) from YouTube
+    except Exception as e:
+        identity_pool.release(identity, time.monotonic() - started, e)
+        raise
+    identity_pool.release(identity, time.monotonic() - started)
+    page = []
+    for entry in fetched:
+        if not entry:
+            continue
+        webpage_url = entry.get('webpage_url') or entry.get('url')
+        if not webpage_url:
+            continue
+        page.append({
+            'title': entry.get('title') or webpage_url,
+            'webpage_url': webpage_url,
+            'duration': entry.get('duration') or 0,
+            'uploader': entry.get('uploader') or entry.get('channel') or 'Unknown Uploader',
+            'source_type': (entry.get('ie_key') or entry.get('extractor_key') or 'unknown_url').lower(),
+        })
+    return page, len(fetched) < page_size
+
+def make_unresolved_song_item(entry, author):
+    """Builds a song_item for a flat playlist entry. It's resolved just before it plays."""
+    return {
+        'query': entry['webpage_url'],
+        'source_type': entry['source_type'],
+        'title': entry['title'],
+        'webpage_url': entry['webpage_url'],
+        'thumbnail_url': None,
+        'duration': entry['duration'],
+        'uploader': entry['uploader'],
+        'stream_url': None, # Filled in by resolve_song_item
+        'requester': author.name,
+        'requester_id': author.id,
+        'requester_avatar_url': str(author.avatar.url) if author.avatar else None,
+    }
+
+async def resolve_song_item(song_item, priority=PRIORITY_PLAY_NOW, guild_id=None):
+    """Fills in an unresolved song_item's stream URL (and anything the flat entry lacked). Returns True on success."""
+    try:
+        youtube_info = await fetch_youtube_info(song_item['webpage_url'], priority=priority, guild_id=guild_id)
+    except ResolverSaturated:
+        return False
+    if not youtube_info:
+        return False
+    song_item['stream_url'] = youtube_info['stream_url']
+    song_item['acodec'] = youtube_info.get('acodec')
+    song_item['resolved_at'] = time.time()
+    song_item['thumbnail_url'] = youtube_info['thumbnail_url']
+    song_item['duration'] = youtube_info['duration'] or song_item['duration']
+    song_item['uploader'] = youtube_info['uploader']
+    return True
+
+async def ingest_playlist(ctx, url, first_priority):
+    """Streams a playlist into the guild's queue page by page."""
+    guild_id = ctx.guild.id
+    entries = None
+    try:
+        playlist = await resolver.submit(_open_playlist, url, priority=first_priority, guild_id=guild_id, user_id=ctx.author.id)
+        if not playlist:
+            await ctx.send(f"Could not load the playlist: `{url}`.")
+            return
+        title, entries, identity = playlist
+        await ctx.send(f"Queuing playlist '{title}'...")
+
+        total = 0
+        page_size = PLAYLIST_FIRST_PAGE_SIZE
+        priority = first_priority
+        while total < PLAYLIST_MAX_ITEMS:
+            page_size = min(page_size, PLAYLIST_MAX_ITEMS - total)
+            page, exhausted = await resolver.submit(_next_playlist_page, entries, identity, page_size, priority=priority, guild_id=guild_id)
+            if page:
+                queued = await get_player(ctx.guild).send('enqueue', items=[make_unresolved_song_item(entry, ctx.author) for entry in page],
+                                                          channel=ctx.channel)
+                total += len(queued)
+                if len(queued) < len(page):
+                    await ctx.send(f"Queued {total} songs from playlist '{title}'. {QUEUE_FULL_MESSAGE}")
+                    return
+            if exhausted:
+                break
+            page_size = PLAYLIST_PAGE_SIZE
+            priority = PRIORITY_BULK # Everything after the first page is background work
+
+        if total >= PLAYLIST_MAX_ITEMS:
+            await ctx.send(f"Queued the first {total} songs from playlist '{title}' (limit reached).")
+        else:
+            await ctx.send(f"Queued {total} songs from playlist '{title}'.")
+    except ResolverSaturated as e:
+        await ctx.send(resolver_refusal_message(e))
+    except PlayerClosed:
+        pass # The bot left the guild (or was removed from it) meanwhile
+    except Exception as e:
+        await ctx.send(f"Error while queuing the playlist: {e}")
+        print(f"Playlist ingestion error: {e}")
+    finally:
+        if playlist_ingestions.get(guild_id) is asyncio.current_task():
+            playlist_ingestions.pop(guild_id, None)
+        if entries is not None:
+            await asyncio.to_thread(close_playlist, entries)
+
+def cancel_playlist_ingestion(guild_id):
+    """Stops a playlist that's still being queued for the guild, if any."""
+    task = playlist_ingestions.pop(guild_id, None)
+    if task:
+        task.cancel()
+
+def _extract_youtube_info(query_or_url: str, strategy='default', audio_format=None):
+    """Blocking part of fetch_youtube_info. Runs on a resolver thread.
+    The 'alternate' strategy (used for hedges) asks YouTube through different player clients. Hedges also
+    end up on a different identity than the request they race, as the pool prefers identities with nothing in flight.
+    """
+    ydl_opts_local = YDL_OPTS.copy()
+    if audio_format:
+        ydl_opts_local['format'] = audio_format
+    if strategy == 'alternate':
+        ydl_opts_local['extractor_args'] = {'youtube': {'player_client': RESOLVER_HEDGE_PLAYER_CLIENTS}}
+    # Single tracks only (noplaylist=True); playlist URLs are streamed by _open_playlist / _next_playlist_page
     is_url = query_or_url.startswith(('http:', 'https:'))
     search_query = query_or_url if is_url else f"ytsearch:{query_or_url}"
 
+    yt_dlp = get_yt_dlp()
     try:
-        with yt_dlp.YoutubeDL(ydl_opts_local) as ydl:
-            info = ydl.extract_info(search_query, download=False)
-            
-            if not info:
-                return None
-
-            # If it's a search and it returned a playlist, take the first video.
-            # If it's a direct URL to a playlist, also take the first video (due to noplaylist=True).
-            if 'entries' in info and info['entries']:
-                video_info = info['entries'][0]
-            elif 'url' in info: # Direct video URL or single search result
-                video_info = info
-            else:
-                return None # No usable video information found
-
-            stream_url = video_info.get('url') # Direct stream URL for some extractors
-            title = video_info.get('title', 'Unknown title')
-            webpage_url = video_info.get('webpage_url', query_or_url if is_url else 'Unknown source') # Original URL if provided
-            duration = video_info.get('duration', 0)
-            thumbnail_url = video_info.get('thumbnail', None)
-            uploader = video_info.get('uploader', video_info.get('channel', 'Unknown Uploader'))
-            # Determine source type based on the extractor yt-dlp used
-            extractor_key = video_info.get('extractor_key', '').lower()
-            source_type = extractor_key if extractor_key else 'unknown_url' if is_url else 'search'
-
-
-            if not stream_url: # Fallback for some cases where 'url' might not be directly available
-                formats = video_info.get('formats', [])
-                for f_format in formats:
-                    # Prefer audio-only if available
-                    if f_format.get('acodec') != 'none' and f_format.get('vcodec') == 'none' and f_format.get('url'):
+        info = extract_info_as_identity(ydl_opts_local, search_query)
+        
+        if not info:
+            return None
+
+        # If it's a search and it returned a playlist, take the first video.
+        # If it's a direct URL to a playlist, also take the first video (due to noplaylist=True).
+        if 'entries' in info and info['entries']:
+            video_info = info['entries'][0]
+        elif 'url' in info: # Direct video URL or single search result
+            video_info = info
+        else:
+            return None # No usable video information found
+
+        stream_url = video_info.get('url') # Direct stream URL for some extractors
+        title = video_info.get('title', 'Unknown title')
+        webpage_url = video_info.get('webpage_url', query_or_url if is_url else 'Unknown source') # Original URL if provided
+        duration = video_info.get('duration', 0)
+        thumbnail_url = video_info.get('thumbnail', None)
+        uploader = video_info.get('uploader', video_info.get('channel', 'Unknown Uploader'))
+        # Determine source type based on the extractor yt-dlp used
+        extractor_key = video_info.get('extractor_key', '').lower()
+        source_type = extractor_key if extractor_key else 'unknown_url' if is_url else 'search'
+
+
+        if not stream_url: # Fallback for some cases where 'url' might not be directly available
+            formats = video_info.get('formats', [])
+            for f_format in formats:
+                # Prefer audio-only if available
+                if f_format.get('acodec') != 'none' and f_format.get('vcodec') == 'none' and f_format.get('url'):
+                    stream_url = f_format.get('url')
+                    break
+            if not stream_url and formats: # Fallback to first format with a URL
+                 for f_format in formats:
+                    if f_format.get('url'):
                         stream_url = f_format.get('url')
                         break
-                if not stream_url and formats: # Fallback to first format with a URL
-                     for f_format in formats:
-                        if f_format.get('url'):
-                            stream_url = f_format.get('url')
-                            break
-            
-            if not stream_url:
-                return None
-
-            return {
-                'title': title, 
-                'stream_url': stream_url, # Renamed from source_url for clarity
-                'webpage_url': webpage_url, 
-                'duration': duration,
-                'thumbnail_url': thumbnail_url,
-                'uploader': uploader,
-                'source_type': source_type 
-            }
+        
+        if not stream_url:
+            return None
+
+        return {
+            'title': title, 
+            'stream_url': stream_url, # Renamed from source_url for clarity
+            'webpage_url': webpage_url, 
+            'duration': duration,
+            'thumbnail_url': thumbnail_url,
+            'uploader': uploader,
+            'source_type': source_type,
+            'acodec': video_info.get('acodec') if stream_url == video_info.get('url') else None, # Only known for the selected format
+        }
 
     except yt_dlp.utils.DownloadError as e:
         # Log discreetly or send a message if needed, but function should return None
@@ -379,18 +2121,116 @@ async def fetch_youtube_info(query_or_url: str): # Ensure this helper is defined
         print(f"fetch_youtube_info generic error: {e}")
         return None
 
-@bot.command(name="play")
-async def play(ctx, *, query: str):
-    """Plays audio from YouTube or Spotify (URL or search query)."""
-    if ctx.author == bot.user:
-        return
+# Spotify -> YouTube matching
+# Instead of fully extracting whatever "<track> <artist> official audio" returns
+# first, a handful of flat search results are scored against the Spotify track
+# (duration, title, artist) and only the best one is fully extracted.
+SPOTIFY_MATCH_CANDIDATES = 5
+SPOTIFY_MATCH_MIN_SCORE = 30 # Below this, fall back to the plain "official audio" search
+SPOTIFY_UNWANTED_VERSIONS = ('cover', 'live', 'karaoke', 'remix', 'instrumental', 'nightcore', 'sped up', 'slowed', 'reverb', '8d', 'reaction')
+spotify_match_stats = {'tracks': 0, 'flat_lookups': 0, 'full_extractions': 0, 'fallbacks': 0} # Lookups only count cache misses
+
+def score_spotify_candidate(candidate, track):
+    """How well a flat YouTube search result matches a Spotify track. Higher is better."""
+    title = candidate['title'].lower()
+    uploader = candidate['uploader'].lower()
+    track_name = track['name'].lower()
+    artists = [artist['name'].lower() for artist in track['artists']]
+    score = 0.0
+
+    # Duration is the strongest signal: long video intros, live cuts and edits are rarely within a few seconds
+    expected_duration = (track.get('duration_ms') or 0) / 1000
+    if expected_duration and candidate['duration']:
+        score += max(0.0, 40 - abs(candidate['duration'] - expected_duration) * 2)
+
+    track_words = set(re.findall(r"\w+", track_name))
+    if track_words:
+        score += 30 * len(track_words & set(re.findall(r"\w+", title))) / len(track_words)
+
+    if any(artist in uploader for artist in artists):
+        score += 20
+    elif any(artist in title for artist in artists):
+        score += 10
+    if uploader.endswith(' - topic'): # YouTube's auto-generated "Artist - Topic" channels carry the studio audio
+        score += 10
+
+    for version in SPOTIFY_UNWANTED_VERSIONS:
+        if re.search(rf"\b{re.escape(version)}\b", title) and version not in track_name:
+            score -= 25
+    return score
+
+async def match_spotify_track(track, priority=PRIORITY_INTERACTIVE, guild_id=None, user_id=None):
+    """Finds and fully extracts the best YouTube match for a Spotify track. Returns fetch_youtube_info's result or None."""
+    track_name = track['name']
+    artist_name = track['artists'][0]['name']
+    spotify_match_stats['tracks'] += 1
+    def count(name):
+        def bump():
+            spotify_match_stats[name] += 1
+        return bump
+    candidates = await fetch_search_results(f"{track_name} {artist_name}", limit=SPOTIFY_MATCH_CANDIDATES,
+                                            priority=priority, guild_id=guild_id, user_id=user_id, on_miss=count('flat_lookups'))
+    best = max(candidates, key=lambda candidate: score_spotify_candidate(candidate, track), default=None)
+    if best is None or score_spotify_candidate(best, track) < SPOTIFY_MATCH_MIN_SCORE:
+        spotify_match_stats['fallbacks'] += 1
+        return await fetch_youtube_info(f"{track_name} {artist_name} official audio", priority=priority, guild_id=guild_id,
+                                        user_id=user_id, on_miss=count('full_extractions'))
+    return await fetch_youtube_info(best['webpage_url'], priority=priority, guild_id=guild_id, user_id=user_id,
+                                    on_miss=count('full_extractions'))
+
+def make_song_item(youtube_info, query, author, source_type=None):
+    """Builds a song_item from fetch_youtube_info's result for the given requester."""
+    return {
+        'query': query,
+        'source_type': source_type or youtube_info['source_type'], # e.g. 'youtube', 'soundcloud', etc.
+        'title': youtube_info['title'],
+        'webpage_url': youtube_info['webpage_url'],
+        'thumbnail_url': youtube_info['thumbnail_url'],
+        'duration': youtube_info['duration'],
+        'uploader': youtube_info['uploader'],
+        'stream_url': youtube_info['stream_url'],
+        'acodec': youtube_info.get('acodec'),
+        'resolved_at': time.time(),
+        'requester': author.name,
+        'requester_id': author.id,
+        'requester_avatar_url': str(author.avatar.url) if author.avatar else None,
+    }
+
+async def enqueue_and_announce(ctx, song_items):
+    """Hands songs to the guild's player and announces the ones that were queued rather than played."""
+    guild_id = ctx.guild.id
+    # The player starts playback itself if nothing is playing
+    queued = await get_player(ctx.guild).send('enqueue', items=song_items, channel=ctx.channel)
+    if len(queued) < len(song_items):
+        await ctx.send(QUEUE_FULL_MESSAGE)
+
+    guild_queue = song_queues.get(guild_id, [])
+    for song_item in queued:
+        if song_item is current_song_info.get(guild_id):
+            continue # The player already announced it as "Now Playing"
+        position = next((i + 1 for i, queued in enumerate(guild_queue) if queued is song_item), None)
+        if position is None:
+            continue # Already played or dropped by the time we got here
+        embed = discord.Embed(
+            title=f"Added to Queue: {song_item['title']}", # Adjusted title
+            url=song_item['webpage_url'],
+            description=f"Position in queue: {position}", # Adjusted description
+            color=discord.Color.orange()
+        )
+        embed.set_author(name=f"Requested by: {song_item['requester']}", icon_url=song_item['requester_avatar_url'])
+        if song_item.get('thumbnail_url'):
+            embed.set_thumbnail(url=song_item['thumbnail_url'])
+        embed.add_field(name="Channel/Uploader", value=song_item.get('uploader', 'N/A'), inline=True)
+        embed.add_field(name="Duration", value=format_duration(song_item.get('duration')), inline=True)
+        await ctx.send(embed=embed)
 
-    # 1. Voice Channel Logic (unchanged, assuming it's fine)
-    if not ctx.author.voice:
+async def join_author_channel(ctx, author):
+    """Joins (or moves to) the author's voice channel. Returns the voice client, or None after telling the user why not."""
+    if not author.voice:
         await ctx.send("You need to be in a voice channel to use this command.")
-        return
-    user_voice_channel = ctx.author.voice.channel
-    voice_client = ctx.voice_client
+        return None
+    user_voice_channel = author.voice.channel
+    voice_client = ctx.guild.voice_client
     if voice_client:
         if voice_client.channel != user_voice_channel:
             await voice_client.move_to(user_voice_channel)
@@ -401,11 +2241,30 @@ async def play(ctx, *, query: str):
             await ctx.send(f"Joined voice channel: {user_voice_channel.name}")
         except Exception as e:
             await ctx.send(f"Error joining voice channel: {e}")
-            return
+            return None
+    return voice_client
+
+RESOLVER_BUSY_MESSAGE = "I'm busy looking up a lot of songs right now. Please try again in a moment."
+
+@bot.command(name="play")
+async def play(ctx, *, query: str):
+    """Plays audio from YouTube or Spotify (URL or search query)."""
+    if ctx.author == bot.user:
+        return
 
     guild_id = ctx.guild.id
-    if guild_id not in song_queues:
-        song_queues[guild_id] = []
+    # Admission control: refuse right away rather than queue behind everyone else
+    if not await admit_play(ctx, ctx.author):
+        return
+    room = queue_room(guild_id, ctx.author.id)
+    if not room:
+        admission_stats['queue_full'] += 1
+        await ctx.send(QUEUE_FULL_MESSAGE)
+        return
+
+    # 1. Voice Channel Logic
+    if not await join_author_channel(ctx, ctx.author):
+        return
 
     # Spotify URL detection
     spotify_track_regex = r"https?://open.spotify.com/track/([a-zA-Z0-9]+)"
@@ -416,227 +2275,528 @@ async def play(ctx, *, query: str):
     match_album = re.match(spotify_album_regex, query)
     match_playlist = re.match(spotify_playlist_regex, query)
 
-    song_items_to_add = []
+    # If the queue is empty, the first song found plays next, so it gets the resolver's top priority
+    first_priority = PRIORITY_PLAY_NOW if not song_queues.get(guild_id) else PRIORITY_INTERACTIVE
 
-    if match_track or match_album or match_playlist:
+    if query.lower().startswith('local:'): # Local library lookup, no network involved
+        if not LOCAL_MUSIC_DIR:
+            await ctx.send("The local music library is not configured.")
+            return
+        local_query = query[len('local:'):].strip()
+        try:
+            tracks = await asyncio.to_thread(_search_library, local_query)
+        except sqlite3.Error as e:
+            await ctx.send("The local music library is not available right now.")
+            print(f"Local library search error: {e}")
+            return
+        if tracks:
+            await enqueue_and_announce(ctx, [make_local_song_item(tracks[0], ctx.author)])
+        else:
+            await ctx.send(f"Nothing in the local library matches `{local_query}`.")
+
+    elif match_track or match_album or match_playlist:
         if not sp:
-            await ctx.send("Spotify API credentials not configured. Cannot play Spotify links.")
+            if spotify_status == 'pending':
+                await ctx.send("Spotify support is still starting up. Please try again in a moment.")
+            else:
+                await ctx.send("Spotify API credentials not configured. Cannot play Spotify links.")
             return
         
         await ctx.send(f"Processing Spotify link: `{query}`...")
+        spotify_tracks = []
         try:
+            # Spotipy is blocking, so its calls run in a thread
             if match_track:
                 track_id = match_track.group(1)
-                spotify_track = sp.track(track_id)
+                spotify_track = await asyncio.to_thread(sp.track, track_id)
                 if spotify_track:
-                    track_name = spotify_track['name']
-                    artist_name = spotify_track['artists'][0]['name']
-                    yt_query = f"{track_name} {artist_name} official audio"
-                    await ctx.send(f"Found '{track_name}' by '{artist_name}' on Spotify. Searching on YouTube...")
-                    youtube_info = await fetch_youtube_info(yt_query)
-                    if youtube_info:
-                        song_items_to_add.append({
-                            'query': f"Spotify: {track_name} - {artist_name}",
-                            'source_type': 'spotify_via_youtube',
-                            'title': youtube_info['title'],
-                            'webpage_url': youtube_info['webpage_url'],
-                            'thumbnail_url': youtube_info['thumbnail_url'],
-                            'duration': youtube_info['duration'],
-                            'uploader': youtube_info['uploader'],
-                            'stream_url': youtube_info['stream_url'],
-                            'requester': ctx.author.name,
-                            'requester_avatar_url': str(ctx.author.avatar.url) if ctx.author.avatar else None,
-                        })
-                        # Message will be sent when actually playing or adding to queue
-                    else:
-                        await ctx.send(f"Could not find a YouTube version for Spotify track: {track_name} - {artist_name}")
+                    spotify_tracks.append(spotify_track)
+                    await ctx.send(f"Found '{spotify_track['name']}' by '{spotify_track['artists'][0]['name']}' on Spotify. Searching on YouTube...")
             
             elif match_album:
                 album_id = match_album.group(1)
-                album_info = sp.album(album_id)
+                album_info = await asyncio.to_thread(sp.album, album_id)
                 album_name = album_info['name']
                 await ctx.send(f"Processing Spotify album: '{album_name}'. Adding up to 10 tracks...")
-                tracks = sp.album_tracks(album_id, limit=10)['items']
-                for i, item in enumerate(tracks):
-                    track_name = item['name']
-                    artist_name = item['artists'][0]['name']
-                    yt_query = f"{track_name} {artist_name} official audio"
-                    await ctx.send(f"({i+1}/10) Searching YouTube for: {track_name} - {artist_name}")
-                    youtube_info = await fetch_youtube_info(yt_query)
-                    if youtube_info:
-                        song_items_to_add.append({
-                            'query': f"Spotify: {track_name} - {artist_name}",
-                            'source_type': 'spotify_via_youtube',
-                            'title': youtube_info['title'],
-                            'webpage_url': youtube_info['webpage_url'],
-                            'thumbnail_url': youtube_info['thumbnail_url'],
-                            'duration': youtube_info['duration'],
-                            'uploader': youtube_info['uploader'],
-                            'stream_url': youtube_info['stream_url'],
-                            'requester': ctx.author.name,
-                            'requester_avatar_url': str(ctx.author.avatar.url) if ctx.author.avatar else None,
-                        })
-                    else:
-                        await ctx.send(f"Could not find YouTube version for: {track_name} - {artist_name}")
+                spotify_tracks = (await asyncio.to_thread(sp.album_tracks, album_id, limit=10))['items']
             
             elif match_playlist:
                 playlist_id = match_playlist.group(1)
-                playlist_info = sp.playlist(playlist_id)
+                playlist_info = await asyncio.to_thread(sp.playlist, playlist_id)
                 playlist_name = playlist_info['name']
                 await ctx.send(f"Processing Spotify playlist: '{playlist_name}'. Adding up to 10 tracks...")
-                results = sp.playlist_items(playlist_id, limit=10)
-                for i, item in enumerate(results['items']):
-                    track = item['track']
-                    if track: # Ensure track object exists
-                        track_name = track['name']
-                        artist_name = track['artists'][0]['name']
-                        yt_query = f"{track_name} {artist_name} official audio"
-                        await ctx.send(f"({i+1}/10) Searching YouTube for: {track_name} - {artist_name}")
-                        youtube_info = await fetch_youtube_info(yt_query)
-                        if youtube_info:
-                            song_items_to_add.append({
-                                'query': f"Spotify: {track_name} - {artist_name}",
-                                'source_type': 'spotify_via_youtube',
-                                'title': youtube_info['title'],
-                                'webpage_url': youtube_info['webpage_url'],
-                                'thumbnail_url': youtube_info['thumbnail_url'],
-                                'duration': youtube_info['duration'],
-                                'uploader': youtube_info['uploader'],
-                                'stream_url': youtube_info['stream_url'],
-                                'requester': ctx.author.name,
-                                'requester_avatar_url': str(ctx.author.avatar.url) if ctx.author.avatar else None,
-                            })
-                        else:
-                            await ctx.send(f"Could not find YouTube version for: {track_name} - {artist_name}")
+                results = await asyncio.to_thread(sp.playlist_items, playlist_id, limit=10)
+                spotify_tracks = [item['track'] for item in results['items'] if item['track']] # Ensure track object exists
         except Exception as e:
             await ctx.send(f"Error processing Spotify link: {e}")
             print(f"Spotify processing error: {e}")
             return # Stop further processing for this command if Spotify part fails
 
+        if len(spotify_tracks) > room:
+            await ctx.send(f"Only {room} more of your songs fit in the queue, skipping the rest.")
+            spotify_tracks = spotify_tracks[:room]
+
+        if len(spotify_tracks) > 1:
+            await ctx.send(f"Searching YouTube for {len(spotify_tracks)} tracks...")
+        # All lookups run concurrently. The first track can start playing as soon as it
+        # resolves; the rest resolve at bulk priority and are queued together afterwards.
+        lookups = [
+            asyncio.create_task(match_spotify_track(
+                track, priority=first_priority if i == 0 else PRIORITY_BULK, guild_id=guild_id, user_id=ctx.author.id))
+            for i, track in enumerate(spotify_tracks)
+        ]
+        added_any = False
+        pending_items = []
+        for i, (track, lookup) in enumerate(zip(spotify_tracks, lookups)):
+            track_name = track['name']
+            artist_name = track['artists'][0]['name']
+            try:
+                youtube_info = await lookup
+            except RateLimited as e:
+                for remaining in lookups[i + 1:]:
+                    remaining.cancel() # They'd be refused too
+                await asyncio.gather(*lookups[i + 1:], return_exceptions=True) # Collects the ones that already failed
+                await ctx.send(f"Skipped {len(spotify_tracks) - i} track(s): {e}")
+                break
+            except ResolverSaturated:
+                youtube_info = None
+                await ctx.send(f"Skipped {track_name} - {artist_name}: {RESOLVER_BUSY_MESSAGE}")
+            else:
+                if not youtube_info:
+                    await ctx.send(f"Could not find YouTube version for: {track_name} - {artist_name}")
+            if youtube_info:
+                pending_items.append(make_song_item(youtube_info, f"Spotify: {track_name} - {artist_name}", ctx.author, 'spotify_via_youtube'))
+            if i == 0 and pending_items:
+                await enqueue_and_announce(ctx, pending_items)
+                added_any = True
+                pending_items = []
+        if pending_items:
+            await enqueue_and_announce(ctx, pending_items)
+            added_any = True
+        if not added_any:
+            # This case should ideally be handled by specific error messages above,
+            # but as a fallback if no items were successfully processed.
+            await ctx.send("No songs were added. Please check your query or Spotify link.")
+
+    elif re.match(PLAYLIST_URL_REGEX, query): # YouTube / SoundCloud playlist, streamed into the queue in the background
+        cancel_playlist_ingestion(guild_id)
+        playlist_ingestions[guild_id] = spawn_background(ingest_playlist(ctx, query, first_priority))
+
     else: # Not a Spotify link, process as direct YouTube URL or search
         await ctx.send(f"Searching YouTube for: `{query}`...")
-        youtube_info = await fetch_youtube_info(query) # query here is the original user input
+        try:
+            youtube_info = await fetch_youtube_info(query, priority=first_priority, guild_id=guild_id, user_id=ctx.author.id) # query here is the original user input
+        except ResolverSaturated as e:
+            await ctx.send(resolver_refusal_message(e))
+            return
         if youtube_info:
-            song_items_to_add.append({
-                'query': query,
-                'source_type': youtube_info['source_type'], # e.g. 'youtube', 'soundcloud', etc.
-                'title': youtube_info['title'],
-                'webpage_url': youtube_info['webpage_url'],
-                'thumbnail_url': youtube_info['thumbnail_url'],
-                'duration': youtube_info['duration'],
-                'uploader': youtube_info['uploader'],
-                'stream_url': youtube_info['stream_url'],
-                'requester': ctx.author.name,
-                'requester_avatar_url': str(ctx.author.avatar.url) if ctx.author.avatar else None,
-            })
+            await enqueue_and_announce(ctx, [make_song_item(youtube_info, query, ctx.author)])
         else:
-            await ctx.send(f"Could not find anything for your query: `{query}`. Note: SoundCloud playlist URLs are not supported for direct queuing of all tracks.")
+            await ctx.send(f"Could not find anything for your query: `{query}`.")
+
+
+class SearchResultsView(discord.ui.View):
+    """Paged select menu over cached !search results. Only the chosen entry is fully resolved."""
+
+    def __init__(self, ctx, query, results, *, timeout=120):
+        super().__init__(timeout=timeout)
+        self.ctx = ctx
+        self.query = query
+        self.results = results
+        self.page = 0
+        self.page_count = (len(results) + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+        self.message = None
+        self.select = discord.ui.Select(placeholder="Pick a song to play")
+        self.select.callback = self.select_callback
+        self.add_item(self.select)
+        self.render()
+
+    def page_results(self):
+        start = self.page * SEARCH_PAGE_SIZE
+        return list(enumerate(self.results[start:start + SEARCH_PAGE_SIZE], start=start))
+
+    def render(self):
+        """Fills the select menu and paging buttons for the current page."""
+        self.select.options = [
+            discord.SelectOption(
+                label=f"{index + 1}. {result['title']}"[:100],
+                description=f"{result['uploader']} · {format_duration(result['duration'])}"[:100],
+                value=str(index)
+            )
+            for index, result in self.page_results()
+        ]
+        self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.page >= self.page_count - 1
+
+    def embed(self):
+        lines = [
+            f"{index + 1}. [{result['title']}]({result['webpage_url']}) - {result['uploader']} ({format_duration(result['duration'])})"
+            for index, result in self.page_results()
+        ]
+        embed = discord.Embed(title=f"Search results for: {self.query}", description="\n".join(lines), color=discord.Color.blue())
+        embed.set_footer(text=f"Page {self.page + 1}/{self.page_count}")
+        return embed
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        if interaction.user.id != self.ctx.author.id:
+            await interaction.response.send_message("Only the person who searched can use this menu.", ephemeral=True)
+            return False
+        return True
+
+    async def on_timeout(self):
+        for child in self.children:
+            child.disabled = True
+        if self.message:
+            try:
+                await self.message.edit(view=self)
+            except discord.NotFound:
+                pass
+
+    async def select_callback(self, interaction: discord.Interaction):
+        result = self.results[int(self.select.values[0])]
+        await interaction.response.defer()
+        if not await admit_play(self.ctx, interaction.user):
+            return
+        if not await join_author_channel(self.ctx, interaction.user):
+            return
+        guild_id = self.ctx.guild.id
+        priority = PRIORITY_PLAY_NOW if not song_queues.get(guild_id) else PRIORITY_INTERACTIVE
+        try:
+            youtube_info = await fetch_youtube_info(result['webpage_url'], priority=priority, guild_id=guild_id, user_id=interaction.user.id)
+        except ResolverSaturated as e:
+            await self.ctx.send(resolver_refusal_message(e))
             return
+        if not youtube_info:
+            await self.ctx.send(f"Could not load `{result['title']}`. Try another result.")
+            return
+        await enqueue_and_announce(self.ctx, [make_song_item(youtube_info, result['webpage_url'], interaction.user)])
+
+    @discord.ui.button(label="Previous", style=discord.ButtonStyle.secondary, emoji="◀️", row=1)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page -= 1
+        self.render()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+    @discord.ui.button(label="Next", style=discord.ButtonStyle.secondary, emoji="▶️", row=1)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.page += 1
+        self.render()
+        await interaction.response.edit_message(embed=self.embed(), view=self)
+
+@bot.command(name="search")
+async def search(ctx, *, query: str):
+    """Searches YouTube and lets you pick which result to play."""
+    if ctx.author == bot.user:
+        return
 
-    if not song_items_to_add:
-        # This case should ideally be handled by specific error messages above,
-        # but as a fallback if no items were successfully processed.
-        await ctx.send("No songs were added. Please check your query or Spotify link.")
+    try:
+        results = await fetch_search_results(query, guild_id=ctx.guild.id, user_id=ctx.author.id)
+    except ResolverSaturated as e:
+        await ctx.send(resolver_refusal_message(e))
+        return
+    if not results:
+        await ctx.send(f"Could not find anything for your query: `{query}`.")
         return
 
-    # Add processed songs to queue and/or play
-    songs_played_directly = 0
-    for i, song_item in enumerate(song_items_to_add):
-        if voice_client.is_playing() or voice_client.is_paused() or (guild_id in song_queues and song_queues[guild_id]):
-            # If already playing or queue is populated (even if we just added to it and it's about to be played)
-            song_queues[guild_id].append(song_item)
-            
-            embed = discord.Embed(
-                title=f"Added to Queue: {song_item['title']}", # Adjusted title
-                url=song_item['webpage_url'],
-                description=f"Position in queue: {len(song_queues[guild_id])}", # Adjusted description
-                color=discord.Color.orange() 
+    view = SearchResultsView(ctx, query, results)
+    view.message = await ctx.send(embed=view.embed(), view=view)
+
+
+# Saved playlists
+# A guild's queue can be saved under a name and queued again later. Tracks are
+# stored already resolved (YouTube video ID plus the metadata needed to show
+# them), so loading one needs no searches; stream URLs are fetched just in
+# time like for any other unresolved song.
+PLAYLIST_DB_PATH = os.getenv('PLAYLIST_DB_PATH', 'playlists.db')
+YOUTUBE_VIDEO_ID_REGEX = r"(?:youtube\.com/watch\?(?:.*&)?v=|youtu\.be/|youtube\.com/shorts/)([A-Za-z0-9_-]{11})"
+
+def _open_playlist_db():
+    conn = sqlite3.connect(PLAYLIST_DB_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS saved_playlists ("
+        " guild_id INTEGER NOT NULL, name TEXT NOT NULL, tracks TEXT NOT NULL, saved_at REAL NOT NULL,"
+        " PRIMARY KEY (guild_id, name))"
+    )
+    return conn
+
+def compact_track(song_item):
+    """Smallest form of a song_item worth storing: [video ID / URL / file path, title, duration, uploader, source_type]."""
+    if song_item.get('source_type') == 'local':
+        return [song_item['stream_url'], song_item['title'], song_item.get('duration') or 0, song_item.get('uploader'), 'local']
+    match = re.search(YOUTUBE_VIDEO_ID_REGEX, song_item.get('webpage_url') or '')
+    key = match.group(1) if match else song_item.get('webpage_url')
+    return [key, song_item['title'], song_item.get('duration') or 0, song_item.get('uploader'), song_item.get('source_type')]
+
+def expand_track(track, author):
+    """Turns a compact_track back into an unresolved song_item requested by author."""
+    key, title, duration, uploader, source_type = track
+    if source_type == 'local':
+        return make_local_song_item({'path': key, 'title': title, 'artist': uploader, 'duration': duration, 'acodec': None}, author)
+    webpage_url = key if '/' in key else f"https://www.youtube.com/watch?v={key}"
+    entry = {'title': title, 'webpage_url': webpage_url, 'duration': duration,
+             'uploader': uploader or 'Unknown Uploader', 'source_type': source_type or 'youtube'}
+    return make_unresolved_song_item(entry, author)
+
+def _save_playlist(guild_id, name, tracks):
+    with contextlib.closing(_open_playlist_db()) as conn, conn:
+        conn.execute("INSERT OR REPLACE INTO saved_playlists (guild_id, name, tracks, saved_at) VALUES (?, ?, ?, ?)",
+                     (guild_id, name, json.dumps(tracks, separators=(',', ':')), time.time()))
+
+def _load_playlist(guild_id, name):
+    with contextlib.closing(_open_playlist_db()) as conn:
+        row = conn.execute("SELECT tracks FROM saved_playlists WHERE guild_id = ? AND name = ?", (guild_id, name)).fetchone()
+    return json.loads(row[0]) if row else None
+
+def _list_playlists(guild_id):
+    with contextlib.closing(_open_playlist_db()) as conn:
+        return [(name, json.loads(tracks)) for name, tracks in
+                conn.execute("SELECT name, tracks FROM saved_playlists WHERE guild_id = ? ORDER BY name", (guild_id,))]
+
+def _delete_playlist(guild_id, name):
+    with contextlib.closing(_open_playlist_db()) as conn, conn:
+        return conn.execute("DELETE FROM saved_playlists WHERE guild_id = ? AND name = ?", (guild_id, name)).rowcount > 0
+
+@bot.group(name="playlist", invoke_without_command=True)
+async def playlist(ctx):
+    """Saves and loads named playlists. Usage: !playlist save|load|delete <name>, !playlist list"""
+    if ctx.author == bot.user:
+        return
+    await ctx.send("Usage: `!playlist save <name>`, `!playlist load <name>`, `!playlist delete <name>` or `!playlist list`.")
+
+@playlist.command(name="save")
+async def playlist_save(ctx, *, name: str):
+    """Saves the current song and queue under a name."""
+    if ctx.author == bot.user:
+        return
+    guild_id = ctx.guild.id
+    current_song = current_song_info.get(guild_id)
+    song_items = ([current_song] if current_song else []) + list(song_queues.get(guild_id, []))
+    if not song_items:
+        await ctx.send(embed=discord.Embed(description="Nothing is playing or queued, so there is nothing to save.", color=discord.Color.orange()))
+        return
+    name = name.strip().lower()[:50]
+    await asyncio.to_thread(_save_playlist, guild_id, name, [compact_track(song_item) for song_item in song_items])
+    await ctx.send(embed=discord.Embed(description=f"Saved {len(song_items)} song(s) as playlist **{name}**.", color=discord.Color.green()))
+
+@playlist.command(name="load")
+async def playlist_load(ctx, *, name: str):
+    """Queues a saved playlist."""
+    if ctx.author == bot.user:
+        return
+    name = name.strip().lower()[:50]
+    tracks = await asyncio.to_thread(_load_playlist, ctx.guild.id, name)
+    if tracks is None:
+        await ctx.send(embed=discord.Embed(description=f"No saved playlist named **{name}**.", color=discord.Color.red()))
+        return
+    if not await admit_play(ctx, ctx.author):
+        return
+    if not await join_author_channel(ctx, ctx.author):
+        return
+    queued = await get_player(ctx.guild).send('enqueue', items=[expand_track(track, ctx.author) for track in tracks], channel=ctx.channel)
+    description = f"Queued {len(queued)} song(s) from playlist **{name}**."
+    if len(queued) < len(tracks):
+        description += f" {QUEUE_FULL_MESSAGE}"
+    await ctx.send(embed=discord.Embed(description=description, color=discord.Color.green()))
+
+@playlist.command(name="list")
+async def playlist_list(ctx):
+    """Lists this server's saved playlists."""
+    if ctx.author == bot.user:
+        return
+    playlists = await asyncio.to_thread(_list_playlists, ctx.guild.id)
+    if not playlists:
+        await ctx.send(embed=discord.Embed(description="No saved playlists yet. Use `!playlist save <name>`.", color=discord.Color.orange()))
+        return
+    lines = [f"**{name}** - {len(tracks)} song(s), {format_duration(sum(track[2] or 0 for track in tracks))}" for name, tracks in playlists]
+    embed = discord.Embed(title="Saved Playlists", description="\n".join(lines)[:4000], color=discord.Color.blue())
+    await ctx.send(embed=embed)
+
+@playlist.command(name="delete")
+async def playlist_delete(ctx, *, name: str):
+    """Deletes a saved playlist."""
+    if ctx.author == bot.user:
+        return
+    name = name.strip().lower()[:50]
+    if await asyncio.to_thread(_delete_playlist, ctx.guild.id, name):
+        await ctx.send(embed=discord.Embed(description=f"Deleted playlist **{name}**.", color=discord.Color.green()))
+    else:
+        await ctx.send(embed=discord.Embed(description=f"No saved playlist named **{name}**.", color=discord.Color.red()))
+
+# Local music library
+# Files under LOCAL_MUSIC_DIR are indexed into a SQLite FTS5 table (tags read
+# with ffprobe), so "!play local:<query>" is a local index lookup and the file
+# is handed to ffmpeg directly. The scanner only probes files that are new or
+# whose mtime/size changed since the last scan, and drops deleted ones.
+LOCAL_MUSIC_DIR = os.getenv('LOCAL_MUSIC_DIR') # Library is off when unset
+LIBRARY_DB_PATH = os.getenv('LIBRARY_DB_PATH', 'library.db')
+LIBRARY_SCAN_INTERVAL_SECONDS = float(os.getenv('LIBRARY_SCAN_INTERVAL_SECONDS', '3600'))
+LIBRARY_AUDIO_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.aac', '.wav', '.webm', '.wma', '.alac', '.aiff')
+LIBRARY_COMMIT_EVERY = 200 # Files probed per transaction, so searches see a first scan's progress
+library_stats = {'tracks': 0, 'last_scan': None, 'last_scan_seconds': None, 'scanning': False}
+
+LIBRARY_SCHEMA_VERSION = 2
+
+def _open_library_db():
+    conn = sqlite3.connect(LIBRARY_DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL") # Searches don't wait for a scan's writes
+    if conn.execute("PRAGMA user_version").fetchone()[0] != LIBRARY_SCHEMA_VERSION:
+        # Older layout: start over, the next scan rebuilds the index from the files
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS library_tracks")
+            conn.execute("DROP TABLE IF EXISTS library_search")
+            conn.execute("DROP TABLE IF EXISTS library_files")
+            # One row per file; tags are NULL for files without audio, so those aren't probed again until they change
+            conn.execute(
+                "CREATE TABLE library_files (id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, mtime REAL NOT NULL, size INTEGER NOT NULL,"
+                " title TEXT, artist TEXT, album TEXT, filename TEXT, duration INTEGER, acodec TEXT)"
             )
-            embed.set_author(name=f"Requested by: {song_item['requester']}", icon_url=song_item['requester_avatar_url'])
-            if song_item.get('thumbnail_url'):
-                embed.set_thumbnail(url=song_item['thumbnail_url'])
-            embed.add_field(name="Channel/Uploader", value=song_item.get('uploader', 'N/A'), inline=True)
-            embed.add_field(name="Duration", value=format_duration(song_item.get('duration')), inline=True)
-            await ctx.send(embed=embed)
-        else:
-            # Play directly if this is the first song and nothing is playing/queued
-            if songs_played_directly == 0:
-                current_song_info[guild_id] = song_item
-                try:
-                    if voice_client.is_connected():
-                        ffmpeg_audio = discord.FFmpegPCMAudio(song_item['stream_url'], **FFMPEG_OPTS)
-                        audio_source_transformed = discord.PCMVolumeTransformer(ffmpeg_audio)
-                        voice_client.play(audio_source_transformed, after=lambda e: play_next_wrapper(ctx, e))
-                        guild_audio_sources[guild_id] = audio_source_transformed
-                        songs_played_directly += 1
-
-                        embed = discord.Embed(
-                            title=song_item['title'], 
-                            url=song_item['webpage_url'], 
-                            color=discord.Color.blue() # Blue for "now playing" (direct)
-                        )
-                        embed.set_author(name=f"Now Playing (Requested by: {song_item['requester']})", icon_url=song_item['requester_avatar_url'])
-                        if song_item.get('thumbnail_url'):
-                            embed.set_thumbnail(url=song_item['thumbnail_url'])
-                        embed.add_field(name="Channel/Uploader", value=song_item.get('uploader', 'N/A'), inline=True)
-                        embed.add_field(name="Duration", value=format_duration(song_item.get('duration')), inline=True)
-                        source_display = {
-                            'youtube': 'YouTube',
-                            'spotify_via_youtube': 'Spotify (via YouTube)',
-                            'soundcloud': 'SoundCloud',
-                            'search': 'Search (YouTube)'
-                        }.get(song_item.get('source_type'), 'Unknown Source')
-                        if song_item.get('source_type') == 'youtube' and 'ytsearch' in song_item.get('query','').lower():
-                             source_display = 'Search (YouTube)'
-                        embed.add_field(name="Source", value=source_display, inline=True)
-                        
-                        # Manage active control messages for direct play
-                        if guild_id in active_control_messages and active_control_messages[guild_id]:
-                            try:
-                                old_message = active_control_messages[guild_id]
-                                disabled_view = PlaybackControlView()
-                                for child_button in disabled_view.children: # Renamed to avoid conflict
-                                    child_button.disabled = True
-                                await old_message.edit(view=disabled_view)
-                            except discord.NotFound:
-                                pass
-                            except Exception as ex:
-                                print(f"Error editing old control message (direct play): {ex}")
-
-                        view = PlaybackControlView()
-                        new_message = await ctx.send(embed=embed, view=view)
-                        active_control_messages[guild_id] = new_message
-                        # await view.update_button_states(ctx) # Needs adjustment
+            # External content index over library_files, keyed by its id and kept in sync by the triggers below
+            conn.execute(
+                "CREATE VIRTUAL TABLE library_search USING fts5("
+                " title, artist, album, filename, content='library_files', content_rowid='id')"
+            )
+            conn.execute(
+                "CREATE TRIGGER library_files_ai AFTER INSERT ON library_files BEGIN"
+                " INSERT INTO library_search (rowid, title, artist, album, filename) VALUES (new.id, new.title, new.artist, new.album, new.filename);"
+                " END"
+            )
+            conn.execute(
+                "CREATE TRIGGER library_files_ad AFTER DELETE ON library_files BEGIN"
+                " INSERT INTO library_search (library_search, rowid, title, artist, album, filename)"
+                " VALUES ('delete', old.id, old.title, old.artist, old.album, old.filename);"
+                " END"
+            )
+            conn.execute(
+                "CREATE TRIGGER library_files_au AFTER UPDATE ON library_files BEGIN"
+                " INSERT INTO library_search (library_search, rowid, title, artist, album, filename)"
+                " VALUES ('delete', old.id, old.title, old.artist, old.album, old.filename);"
+                " INSERT INTO library_search (rowid, title, artist, album, filename) VALUES (new.id, new.title, new.artist, new.album, new.filename);"
+                " END"
+            )
+            conn.execute(f"PRAGMA user_version = {LIBRARY_SCHEMA_VERSION}")
+    return conn
 
+def _probe_audio_file(path):
+    """Reads a file's tags, duration and audio codec with ffprobe. Returns None if it has no audio."""
+    try:
+        result = subprocess.run(
+            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', '-select_streams', 'a:0', path],
+            capture_output=True, timeout=30
+        )
+        probe = json.loads(result.stdout or b'{}')
+    except (OSError, subprocess.TimeoutExpired, ValueError) as e:
+        print(f"ffprobe failed for {path}: {e}")
+        return None
+    if not probe.get('streams'):
+        return None
+    stream = probe['streams'][0]
+    tags = {}
+    for source in (stream.get('tags') or {}, probe.get('format', {}).get('tags') or {}): # Container tags win
+        tags.update({key.lower(): value for key, value in source.items()})
+    try:
+        duration = int(float(probe.get('format', {}).get('duration') or stream.get('duration') or 0))
+    except ValueError:
+        duration = 0
+    filename = os.path.splitext(os.path.basename(path))[0]
+    return {
+        'title': tags.get('title') or filename,
+        'artist': tags.get('artist') or tags.get('album_artist') or '',
+        'album': tags.get('album') or '',
+        'filename': filename,
+        'duration': duration,
+        'acodec': stream.get('codec_name'),
+    }
+
+def _scan_library(root):
+    """Brings the index in line with the files under root. Blocking; runs in a thread."""
+    on_disk = {}
+    for directory, _, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(LIBRARY_AUDIO_EXTENSIONS):
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                on_disk[path] = (stat.st_mtime, stat.st_size)
+
+    probed = removed = 0
+    with contextlib.closing(_open_library_db()) as conn:
+        indexed = {path: (file_id, (mtime, size)) for file_id, path, mtime, size in conn.execute("SELECT id, path, mtime, size FROM library_files")}
+        with conn:
+            for path in indexed.keys() - on_disk.keys():
+                conn.execute("DELETE FROM library_files WHERE id = ?", (indexed[path][0],)) # The trigger updates the index by rowid
+                removed += 1
+        changed = [path for path, signature in on_disk.items() if path not in indexed or indexed[path][1] != signature]
+        for batch_start in range(0, len(changed), LIBRARY_COMMIT_EVERY):
+            with conn:
+                for path in changed[batch_start:batch_start + LIBRARY_COMMIT_EVERY]:
+                    track = _probe_audio_file(path) or {}
+                    values = (*on_disk[path], track.get('title'), track.get('artist'), track.get('album'),
+                              track.get('filename'), track.get('duration'), track.get('acodec'))
+                    if path in indexed:
+                        conn.execute("UPDATE library_files SET mtime = ?, size = ?, title = ?, artist = ?, album = ?, filename = ?,"
+                                     " duration = ?, acodec = ? WHERE id = ?", (*values, indexed[path][0]))
                     else:
-                        await ctx.send("Bot is not connected to a voice channel anymore.")
-                        current_song_info.pop(guild_id, None)
-                        if guild_id in guild_audio_sources: del guild_audio_sources[guild_id]
-                        # If connection lost, add remaining to queue if any
-                        if i < len(song_items_to_add): song_queues[guild_id].extend(song_items_to_add[i:])
-                        break 
-                except Exception as e:
-                    await ctx.send(f"Error starting playback for {song_item['title']}: {e}")
-                    current_song_info.pop(guild_id, None)
-                    if guild_id in guild_audio_sources: del guild_audio_sources[guild_id]
-                    # If error on first direct play, add remaining to queue
-                    if i < len(song_items_to_add): song_queues[guild_id].extend(song_items_to_add[i:])
-                    break
-            else: # This song should be added to queue as one was already played directly
-                 song_queues[guild_id].append(song_item)
-                 embed = discord.Embed(
-                    title=f"Added to Queue: {song_item['title']}", # Adjusted title
-                    url=song_item['webpage_url'],
-                    description=f"Position in queue: {len(song_queues[guild_id])}", # Adjusted description
-                    color=discord.Color.orange()
-                )
-                 embed.set_author(name=f"Requested by: {song_item['requester']}", icon_url=song_item['requester_avatar_url'])
-                 if song_item.get('thumbnail_url'):
-                    embed.set_thumbnail(url=song_item['thumbnail_url'])
-                 embed.add_field(name="Channel/Uploader", value=song_item.get('uploader', 'N/A'), inline=True)
-                 embed.add_field(name="Duration", value=format_duration(song_item.get('duration')), inline=True)
-                 await ctx.send(embed=embed)
-
+                        conn.execute("INSERT INTO library_files (mtime, size, title, artist, album, filename, duration, acodec, path)"
+                                     " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", (*values, path))
+                    if track:
+                        probed += 1
+        total = conn.execute("SELECT COUNT(*) FROM library_files WHERE title IS NOT NULL").fetchone()[0]
+    return probed, removed, total
+
+async def library_scanner():
+    """Rescans LOCAL_MUSIC_DIR every LIBRARY_SCAN_INTERVAL_SECONDS."""
+    while True:
+        if os.path.isdir(LOCAL_MUSIC_DIR):
+            started = time.perf_counter()
+            library_stats['scanning'] = True
+            try:
+                probed, removed, total = await asyncio.to_thread(_scan_library, LOCAL_MUSIC_DIR)
+            except Exception as e:
+                print(f"Local library scan failed: {e}")
+            else:
+                library_stats.update(tracks=total, last_scan=time.time(), last_scan_seconds=time.perf_counter() - started)
+                if probed or removed:
+                    print(f"Local library: {probed} file(s) indexed, {removed} removed, {total} track(s) in total.")
+            finally:
+                library_stats['scanning'] = False
+        else:
+            print(f"LOCAL_MUSIC_DIR '{LOCAL_MUSIC_DIR}' is not a directory; the local library is empty.")
+        await asyncio.sleep(LIBRARY_SCAN_INTERVAL_SECONDS)
+
+def _search_library(query, limit=1):
+    """Best matches for a free text query, every word matching as a prefix of some tag or the file name."""
+    words = re.findall(r"\w+", query)
+    if not words:
+        return []
+    match_expression = " ".join(f'"{word}"*' for word in words)
+    with contextlib.closing(_open_library_db()) as conn:
+        rows = conn.execute(
+            "SELECT library_files.path, library_files.title, library_files.artist, library_files.duration, library_files.acodec"
+            " FROM library_search JOIN library_files ON library_files.id = library_search.rowid"
+            " WHERE library_search MATCH ? ORDER BY bm25(library_search, 10.0, 5.0, 2.0, 1.0) LIMIT ?",
+            (match_expression, limit)
+        ).fetchall()
+    return [{'path': path, 'title': title, 'artist': artist, 'duration': int(duration or 0), 'acodec': acodec}
+            for path, title, artist, duration, acodec in rows]
+
+def make_local_song_item(track, author):
+    """Builds a song_item for a library track. The file path is its stream URL, so it never needs resolving."""
+    return {
+        'query': f"local:{track['path']}",
+        'source_type': 'local',
+        'title': track['title'],
+        'webpage_url': None,
+        'thumbnail_url': None,
+        'duration': track['duration'],
+        'uploader': track['artist'] or 'Unknown Artist',
+        'stream_url': track['path'],
+        'acodec': track['acodec'],
+        'requester': author.name,
+        'requester_id': author.id,
+        'requester_avatar_url': str(author.avatar.url) if author.avatar else None,
+    }
 
 @bot.command(name="pause")
 @commands.check(user_in_same_voice_channel)
@@ -673,42 +2833,16 @@ async def stop(ctx):
     if ctx.author == bot.user:
         return
     
-    voice_client = ctx.voice_client # Check ensures voice_client exists and is connected
     guild_id = ctx.guild.id
-    
-    if voice_client.is_playing() or voice_client.is_paused():
-        voice_client.stop() # This will trigger the 'after' callback.
-                                # play_next will then clear current_song_info if queue is empty.
-        
-        if guild_id in song_queues:
-            song_queues[guild_id].clear()
-            await ctx.send("Queue cleared.")
-        current_song_info.pop(guild_id, None) 
-        if guild_id in guild_audio_sources: # Clear audio source on stop
-            del guild_audio_sources[guild_id]
+    had_queue = bool(song_queues.get(guild_id))
+    was_playing = await get_player(ctx.guild).send('stop')
 
-        await voice_client.disconnect()
+    if was_playing:
+        if had_queue:
+            await ctx.send("Queue cleared.")
         await ctx.send("Disconnected from the voice channel.")
     else:
-        await ctx.send("I am not connected to a voice channel.")
-        # Ensure cleanup if stop is called when not connected but data might exist
-        guild_id = ctx.guild.id 
-        if guild_id in guild_audio_sources: del guild_audio_sources[guild_id]
-        if guild_id in current_song_info: del current_song_info[guild_id]
-        if guild_id in song_queues: song_queues[guild_id].clear() # Also clear queue on stop
-        
-        if guild_id in active_control_messages and active_control_messages[guild_id]:
-            try:
-                old_message = active_control_messages.pop(guild_id)
-                if old_message:
-                    disabled_view = PlaybackControlView()
-                    for child_button_view in disabled_view.children: # Renamed variable
-                        child_button_view.disabled = True
-                    await old_message.edit(view=disabled_view)
-            except discord.NotFound:
-                pass
-            except Exception as ex:
-                print(f"Error editing old control message on stop (not connected scenario): {ex}")
+        await ctx.send("Nothing was playing. Disconnected from the voice channel.")
 
 
 @bot.command(name="skip")
@@ -719,17 +2853,28 @@ async def skip(ctx):
         return
         
     voice_client = ctx.voice_client # Check ensures voice_client exists and is connected
-    # guild_id = ctx.guild.id # No longer needed here directly for current_song_info pop
 
     if voice_client.is_playing() or voice_client.is_paused():
         # Send simple text message as ephemeral, or a small embed
         await ctx.send(embed=discord.Embed(description="Skipping current song...", color=discord.Color.blue()), delete_after=5)
-        voice_client.stop()  # Triggers play_next via 'after' callback, which handles current_song_info
+        get_player(ctx.guild).post('skip') # The player stops the song; its 'after' callback advances the queue
     else:
         # This case should ideally be less frequent if button is disabled, but good for direct command use
         await ctx.send(embed=discord.Embed(description="Not playing anything to skip.", color=discord.Color.orange()))
 
 
+@bot.command(name="previous", aliases=["prev"])
+@commands.check(user_in_same_voice_channel)
+async def previous(ctx):
+    """Goes back to the previous song."""
+    if ctx.author == bot.user:
+        return
+
+    song_item = await get_player(ctx.guild).send('previous')
+    if song_item is None:
+        await ctx.send(embed=discord.Embed(description="There is no previous song.", color=discord.Color.orange()))
+
+
 @bot.command(name="queue", aliases=["q"])
 async def queue_command(ctx):
     """Displays the current song queue."""
@@ -744,30 +2889,7 @@ async def queue_command(ctx):
     embed_description_parts = []
 
     if current_song:
-        embed = discord.Embed(
-            title=current_song['title'],
-            url=current_song.get('webpage_url'),
-            color=discord.Color.green() # Green for "Now Playing"
-        )
-        embed.set_author(
-            name=f"Now Playing (Requested by: {current_song['requester']})",
-            icon_url=current_song.get('requester_avatar_url')
-        )
-        if current_song.get('thumbnail_url'):
-            embed.set_thumbnail(url=current_song['thumbnail_url'])
-        
-        embed.add_field(name="Channel/Uploader", value=current_song.get('uploader', 'N/A'), inline=True)
-        embed.add_field(name="Duration", value=format_duration(current_song.get('duration')), inline=True)
-        
-        source_display = {
-            'youtube': 'YouTube',
-            'spotify_via_youtube': 'Spotify (via YouTube)',
-            'soundcloud': 'SoundCloud',
-            'search': 'Search (YouTube)'
-        }.get(current_song.get('source_type'), 'Unknown Source')
-        if current_song.get('source_type') == 'youtube' and 'ytsearch' in current_song.get('query','').lower():
-            source_display = 'Search (YouTube)'
-        embed.add_field(name="Source", value=source_display, inline=True)
+        embed = now_playing_embed(current_song, discord.Color.green()) # Green for "Now Playing"
 
     else: # Nothing currently playing
         embed = discord.Embed(
@@ -785,7 +2907,7 @@ async def queue_command(ctx):
             duration_str = format_duration(song_item.get('duration'))
             requester_str = song_item.get('requester', 'Unknown')
             embed_description_parts.append(
-                f"{i+1}. [{song_item['title']}]({song_item.get('webpage_url', '#')}) - Req: {requester_str} ({duration_str})\n"
+                f"{i+1}. {queue_entry_title(song_item)} - Req: {requester_str} ({duration_str})\n"
             )
         if len(guild_queue) > max_queue_display:
             embed_description_parts.append(f"...and {len(guild_queue) - max_queue_display} more song(s).\n")
@@ -818,37 +2940,13 @@ async def nowplaying(ctx):
        guild_id in current_song_info:
         
         song_item = current_song_info[guild_id]
-        embed = discord.Embed(
-            title=song_item['title'], 
-            url=song_item['webpage_url'], 
-            color=discord.Color.green() # Green for "now playing"
-        )
-        embed.set_author(name=f"Now Playing (Requested by: {song_item['requester']})", icon_url=song_item['requester_avatar_url'])
-        if song_item.get('thumbnail_url'):
-            embed.set_thumbnail(url=song_item['thumbnail_url'])
-        
-        embed.add_field(name="Channel/Uploader", value=song_item.get('uploader', 'N/A'), inline=True)
-        embed.add_field(name="Duration", value=format_duration(song_item.get('duration')), inline=True)
-        
-        source_display = {
-            'youtube': 'YouTube',
-            'spotify_via_youtube': 'Spotify (via YouTube)',
-            'soundcloud': 'SoundCloud',
-            'search': 'Search (YouTube)'
-        }.get(song_item.get('source_type'), 'Unknown Source')
-        if song_item.get('source_type') == 'youtube' and 'ytsearch' in song_item.get('query','').lower():
-            source_display = 'Search (YouTube)'
-        
-        embed.add_field(name="Source", value=source_display, inline=True)
+        embed = now_playing_embed(song_item, discord.Color.green()) # Green for "now playing"
         
         # Add queue position if possible (might be complex to get accurately without queue access here)
         # For now, !queue command shows full queue.
         
         await ctx.send(embed=embed)
     else:
-        if guild_id in current_song_info and not (voice_client and (voice_client.is_playing() or voice_client.is_paused())):
-             current_song_info.pop(guild_id, None) # Clear stale info
-        
         embed = discord.Embed(description="Nothing is currently playing.", color=discord.Color.orange())
         await ctx.send(embed=embed)
 
@@ -858,11 +2956,7 @@ async def shuffle(ctx):
     if ctx.author == bot.user:
         return
 
-    guild_id = ctx.guild.id
-    if guild_id in song_queues and song_queues[guild_id]:
-        queue = song_queues[guild_id]
-        random.shuffle(queue)
-        
+    if await get_player(ctx.guild).send('shuffle'):
         embed = discord.Embed(
             title="Queue Shuffled",
             description="The song queue has been randomized.",
@@ -879,7 +2973,7 @@ async def shuffle(ctx):
 
 @bot.command(name="loop")
 async def loop(ctx, mode: str = None):
-    """Sets or shows the current loop mode. Modes: off, song."""
+    """Sets or shows the current loop mode. Modes: off, song, queue."""
     if ctx.author == bot.user:
         return
 
@@ -901,18 +2995,102 @@ async def loop(ctx, mode: str = None):
         guild_loop_states[guild_id] = 'song'
         embed = discord.Embed(description="Looping current **song**.", color=discord.Color.green())
         await ctx.send(embed=embed)
-    # Placeholder for 'queue' mode in a future task
-    # elif mode.lower() == 'queue':
-    #     guild_loop_states[guild_id] = 'queue'
-    #     embed = discord.Embed(description="Looping current **queue**.", color=discord.Color.green())
-    #     await ctx.send(embed=embed)
+    elif mode.lower() == 'queue':
+        guild_loop_states[guild_id] = 'queue'
+        embed = discord.Embed(description="Looping current **queue**.", color=discord.Color.green())
+        await ctx.send(embed=embed)
     else:
         embed = discord.Embed(
-            description="Invalid loop mode. Available modes: `off`, `song`.", # Add `queue` when implemented
+            description="Invalid loop mode. Available modes: `off`, `song`, `queue`.",
             color=discord.Color.red()
         )
         await ctx.send(embed=embed)
 
+@bot.command(name="autoplay", aliases=["radio"])
+async def autoplay(ctx, mode: str = None):
+    """Turns autoplay on or off: when the queue runs out, related songs keep playing.
+    Usage: !autoplay (toggles) or !autoplay on|off
+    """
+    if ctx.author == bot.user:
+        return
+
+    guild_id = ctx.guild.id
+    if mode is None:
+        enable = guild_id not in guild_radios
+    elif mode.lower() in ('on', 'off'):
+        enable = mode.lower() == 'on'
+    else:
+        await ctx.send(embed=discord.Embed(description="Usage: `!autoplay [on|off]`.", color=discord.Color.red()))
+        return
+
+    if enable:
+        radio = guild_radios.get(guild_id)
+        if radio is None:
+            radio = guild_radios[guild_id] = GuildRadio(ctx.guild)
+            guild_queue = song_queues.get(guild_id)
+            for song_item in (guild_queue.items[:guild_queue.cursor + 1] if guild_queue else []):
+                radio.remember(song_item) # Seeds the radio with what already played
+        if guild_id in current_song_info and len(song_queues.get(guild_id) or []) < RADIO_PREFETCH:
+            radio.fill()
+        embed = discord.Embed(description="Autoplay turned **on**. Related songs will play when the queue runs out.", color=discord.Color.green())
+    else:
+        radio = guild_radios.pop(guild_id, None)
+        if radio:
+            radio.reset()
+        embed = discord.Embed(description="Autoplay turned **off**.", color=discord.Color.green())
+    await ctx.send(embed=embed)
+
+async def set_audio_filter(ctx, name, value):
+    """Changes one of the guild's audio filters and re-applies them to the current song at its current position."""
+    filters = dict(get_audio_filters(ctx.guild.id))
+    filters[name] = value
+    guild_audio_filters[ctx.guild.id] = filters
+    await get_player(ctx.guild).send('rebuild')
+
+@bot.command(name="bassboost")
+@commands.check(user_in_same_voice_channel)
+async def bassboost(ctx, level: str = None):
+    """Sets the bass boost: off, low, medium, high or a gain in dB (1-20). Without a level, toggles medium."""
+    if ctx.author == bot.user:
+        return
+
+    current_gain = get_audio_filters(ctx.guild.id)['bassboost']
+    if level is None:
+        gain = 0 if current_gain else BASS_BOOST_LEVELS['medium']
+    elif level.lower() in BASS_BOOST_LEVELS:
+        gain = BASS_BOOST_LEVELS[level.lower()]
+    elif level.isdigit() and 1 <= int(level) <= 20:
+        gain = int(level)
+    else:
+        await ctx.send(embed=discord.Embed(description="Invalid level. Use `off`, `low`, `medium`, `high` or a number from 1 to 20.", color=discord.Color.red()))
+        return
+
+    await set_audio_filter(ctx, 'bassboost', gain)
+    description = f"Bass boost set to **+{gain} dB**." if gain else "Bass boost turned **off**."
+    await ctx.send(embed=discord.Embed(description=description, color=discord.Color.green()))
+
+@bot.command(name="nightcore")
+@commands.check(user_in_same_voice_channel)
+async def nightcore(ctx):
+    """Toggles nightcore (faster, higher pitched playback)."""
+    if ctx.author == bot.user:
+        return
+
+    enabled = not get_audio_filters(ctx.guild.id)['nightcore']
+    await set_audio_filter(ctx, 'nightcore', enabled)
+    await ctx.send(embed=discord.Embed(description=f"Nightcore turned **{'on' if enabled else 'off'}**.", color=discord.Color.green()))
+
+@bot.command(name="normalize")
+@commands.check(user_in_same_voice_channel)
+async def normalize(ctx):
+    """Toggles loudness normalization, so every song plays at about the same loudness."""
+    if ctx.author == bot.user:
+        return
+
+    enabled = not get_audio_filters(ctx.guild.id)['normalize']
+    await set_audio_filter(ctx, 'normalize', enabled)
+    await ctx.send(embed=discord.Embed(description=f"Loudness normalization turned **{'on' if enabled else 'off'}**.", color=discord.Color.green()))
+
 @bot.command(name="volume")
 async def volume(ctx, level: str = None):
     """Adjusts the playback volume or displays current volume.
@@ -934,7 +3112,7 @@ async def volume(ctx, level: str = None):
         await ctx.send(embed=discord.Embed(description="Not currently playing anything.", color=discord.Color.orange()))
         return
 
-    if not isinstance(audio_source, discord.PCMVolumeTransformer):
+    if not isinstance(audio_source, TrackedAudio):
         await ctx.send("Volume is not adjustable for the current audio source.")
         # This might also indicate an issue if guild_audio_sources[guild_id] was not set correctly
         if guild_id in guild_audio_sources: # Clean up if it's an invalid source
@@ -951,6 +3129,10 @@ async def volume(ctx, level: str = None):
             volume_value = int(level)
             if 0 <= volume_value <= 200:
                 audio_source.volume = volume_value / 100.0
+                song_item = current_song_info.get(guild_id)
+                if song_item and audio_source.passthrough != can_pass_through(song_item, guild_id, audio_source.volume):
+                    # Opus pass-through can't scale volume: switch to decoding, or back once at 100%
+                    await get_player(ctx.guild).send('rebuild')
                 await ctx.send(f"Volume set to {volume_value}%.")
             else:
                 await ctx.send("Volume must be between 0 and 200.")
@@ -960,13 +3142,70 @@ async def volume(ctx, level: str = None):
             await ctx.send(f"An error occurred while setting volume: {e}")
             print(f"Error in volume command: {e}")
 
+@bot.command(name="stats")
+async def stats(ctx):
+    """Shows the bot's internal load: resolver queue depth and wait time per priority class."""
+    if ctx.author == bot.user:
+        return
+
+    embed = discord.Embed(title="Bot Stats", color=discord.Color.blue())
+    for name, class_stats in resolver.snapshot().items():
+        embed.add_field(
+            name=f"Resolver: {name}",
+            value=(f"Pending: {class_stats['depth']}\n"
+                   f"Done: {class_stats['completed']}/{class_stats['submitted']} (shed: {class_stats['shed']})\n"
+                   f"Wait: avg {class_stats['avg_wait']:.2f}s, p95 {class_stats['p95_wait']:.2f}s\n"
+                   f"Resolve time: p99 {class_stats['p99_latency']:.2f}s"),
+            inline=True
+        )
+    hedging = resolver.hedge_snapshot()
+    embed.add_field(
+        name="Resolver: hedging",
+        value=(f"Launched: {hedging['launched']}, won: {hedging['won']}\n"
+               f"Deadline: {hedging['delay']:.2f}s" if hedging['enabled'] else "Off"),
+        inline=True
+    )
+    embed.add_field(
+        name="Spotify matching",
+        value=(f"Tracks: {spotify_match_stats['tracks']}\n"
+               f"Flat searches: {spotify_match_stats['flat_lookups']}\n"
+               f"Full extractions: {spotify_match_stats['full_extractions']}"
+               f" ({spotify_match_stats['full_extractions'] / max(1, spotify_match_stats['tracks']):.2f} per track)\n"
+               f"Fallback searches: {spotify_match_stats['fallbacks']}"),
+        inline=True
+    )
+    if LOCAL_MUSIC_DIR:
+        last_scan = library_stats['last_scan']
+        embed.add_field(
+            name="Local library",
+            value=(f"Tracks: {library_stats['tracks']}\n"
+                   + ("Scanning now" if library_stats['scanning'] else
+                      f"Last scan: {format_duration(int(time.time() - last_scan))} ago ({library_stats['last_scan_seconds']:.1f}s)" if last_scan else "Not scanned yet")),
+            inline=True
+        )
+    identity_lines = []
+    for identity in identity_pool.snapshot():
+        state = f"backing off {identity['backing_off']:.0f}s" if identity['backing_off'] else "ok"
+        identity_lines.append(f"**{identity['name']}**: {state}, {identity['requests']} req, {identity['errors']} err "
+                              f"({identity['throttles']} throttled), p50 {identity['p50_latency']:.2f}s, p95 {identity['p95_latency']:.2f}s")
+    embed.add_field(name="yt-dlp identities", value="\n".join(identity_lines)[:1024], inline=False)
+    embed.add_field(
+        name="Admission control",
+        value=(f"Plays refused: {admission_stats['plays_limited']}\n"
+               f"Lookups refused: {admission_stats['lookups_limited']}\n"
+               f"Songs over queue limits: {admission_stats['queue_full']}"),
+        inline=True
+    )
+    embed.add_field(
+        name="Audio streams",
+        value=(f"Opus pass-through: {stream_stats['passthrough']}\n"
+               f"Transcoded: {stream_stats['transcoded']}\n"
+               f"Stalls: {stream_health['stalls']}, recovered: {stream_health['recoveries']}, "
+               f"skipped: {stream_health['failed_recoveries']}"),
+        inline=True
+    )
+    await ctx.send(embed=embed)
 
-# Run the bot
-if __name__ == "__main__":
-    if DISCORD_TOKEN:
-        bot.run(DISCORD_TOKEN)
-    else:
-        print("Error: DISCORD_TOKEN not found in .env file.")
 
 # Playback Control View
 class PlaybackControlView(discord.ui.View):
@@ -1026,12 +3265,11 @@ class PlaybackControlView(discord.ui.View):
     @discord.ui.button(label="Skip", style=discord.ButtonStyle.secondary, emoji="⏭️", custom_id="skip_button", row=0)
     async def skip_callback(self, interaction: discord.Interaction, button: discord.ui.Button):
         voice_client = interaction.guild.voice_client
-        guild_id = interaction.guild.id
 
         if voice_client and (voice_client.is_playing() or voice_client.is_paused()):
             await interaction.response.send_message("Skipping to the next song...", ephemeral=True)
-            voice_client.stop() # Triggers play_next via 'after' callback
-            # play_next will handle new message with its own view or disable if queue empty
+            get_player(interaction.guild).post('skip')
+            # The player will send a new message with its own view or disable this one if the queue is empty
         else:
             await interaction.response.send_message("Nothing to skip.", ephemeral=True)
             button.disabled = True
@@ -1041,20 +3279,11 @@ class PlaybackControlView(discord.ui.View):
     @discord.ui.button(label="Stop", style=discord.ButtonStyle.danger, emoji="⏹️", custom_id="stop_button", row=0)
     async def stop_callback(self, interaction: discord.Interaction, button: discord.ui.Button):
         voice_client = interaction.guild.voice_client
-        guild_id = interaction.guild.id
 
         if voice_client and voice_client.is_connected():
-            if guild_id in song_queues:
-                song_queues[guild_id].clear()
-            current_song_info.pop(guild_id, None)
-            if guild_id in guild_audio_sources:
-                del guild_audio_sources[guild_id]
-            
-            if voice_client.is_playing() or voice_client.is_paused():
-                voice_client.stop()
-            
-            await voice_client.disconnect()
+            # Answer the interaction first; the player clears the queue and disconnects in order
             await interaction.response.send_message("Playback stopped and bot disconnected.", ephemeral=True)
+            get_player(interaction.guild).post('stop')
 
             # Disable all buttons on this view
             for child_button in self.children:
@@ -1062,13 +3291,20 @@ class PlaybackControlView(discord.ui.View):
             if interaction.message: # Ensure message exists before trying to edit
                  await interaction.message.edit(view=self)
             self.stop() # Stop the view itself (removes from listening)
-            
-            # Clear this message from active_control_messages if it's the one
-            if active_control_messages.get(guild_id) == interaction.message:
-                active_control_messages.pop(guild_id, None)
         else:
             await interaction.response.send_message("Not connected to a voice channel.", ephemeral=True)
             button.disabled = True
             if interaction.message:
                 await interaction.message.edit(view=self)
             self.stop() # Also stop view if bot wasn't connected
+
+
+# Run the bot
+# This must stay at the very end of the file: bot.run() blocks, so anything
+# defined below it (e.g. PlaybackControlView) would not exist while the bot runs.
+if __name__ == "__main__":
+    if DISCORD_TOKEN:
+        startup_timings['module_loaded'] = time.perf_counter() - _BOOT_STARTED
+        bot.run(DISCORD_TOKEN)
+    else:
+        print("Error: DISCORD_TOKEN not found in .env file.")
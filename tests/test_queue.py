@@ -0,0 +1,131 @@
+"""GuildQueue and GuildPlayer behaviour, driven through the player the way the commands use it."""
+import asyncio
+import os
+import sys
+
+import discord
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bot
+
+GUILD_ID = 1234
+QUEUE_SIZE = 150
+
+class FakeVoiceClient:
+    def __init__(self):
+        self.source = None
+
+    def is_connected(self):
+        return True
+
+    def is_playing(self):
+        return self.source is not None
+
+    def is_paused(self):
+        return False
+
+    def play(self, source, after=None, bitrate=None):
+        self.source = source
+
+    def stop(self):
+        self.source = None
+
+class FakeChannel:
+    async def send(self, *args, **kwargs):
+        return None
+
+class FakeGuild:
+    id = GUILD_ID
+
+    def __init__(self):
+        self.voice_client = FakeVoiceClient()
+
+def make_song(number):
+    return {'title': f"Song {number}", 'webpage_url': f"https://example.com/{number}", 'stream_url': f"https://cdn.example.com/{number}",
+            'duration': 600, 'requester': 'tester', 'requester_id': 1, 'source_type': 'generic'}
+
+@pytest.fixture
+def player_env(monkeypatch):
+    async def no_control_message(guild_id, message=None):
+        pass
+    monkeypatch.setattr(bot, 'create_ffmpeg_source', lambda song_item, guild_id, **kwargs: object())
+    monkeypatch.setattr(bot, 'TrackedAudio', lambda source, speed=1.0: source)
+    monkeypatch.setattr(bot, 'channel_bitrate_kbps', lambda guild: 128)
+    monkeypatch.setattr(bot, 'PlaybackControlView', lambda: None)
+    monkeypatch.setattr(bot, 'now_playing_embed', lambda song_item, color: None)
+    monkeypatch.setattr(bot, 'disable_control_message', no_control_message)
+    monkeypatch.setattr(bot, 'MAX_QUEUE_LENGTH', 1000)
+    bot.guild_loop_states[GUILD_ID] = 'queue'
+    queue = bot.song_queues[GUILD_ID] = bot.GuildQueue()
+    queue.extend(make_song(number) for number in range(QUEUE_SIZE))
+    yield queue
+    for state in (bot.guild_loop_states, bot.song_queues, bot.current_song_info, bot.guild_audio_sources,
+                  bot.active_control_messages, bot.guild_players):
+        state.pop(GUILD_ID, None)
+
+def run_with_player(coro_factory):
+    async def main():
+        guild = FakeGuild()
+        player = bot.get_player(guild)
+        player.channel = FakeChannel()
+        try:
+            await coro_factory(player)
+        finally:
+            player.close()
+    asyncio.run(main())
+
+def test_previous_keeps_the_looping_queue(player_env):
+    queue = player_env
+    queue.cursor = 119
+    bot.current_song_info[GUILD_ID] = queue.items[119]
+
+    async def go_back(player):
+        assert (await player.send('previous'))['title'] == "Song 118"
+
+    run_with_player(go_back)
+    assert len(queue.items) == QUEUE_SIZE
+    assert queue.items[queue.cursor]['title'] == "Song 118"
+
+def test_enqueue_while_idle_keeps_the_looping_queue(player_env):
+    queue = player_env
+    queue.cursor = 119 # Song 119 finished, nothing is playing
+
+    async def add_song(player):
+        await player.send('enqueue', items=[make_song(QUEUE_SIZE)], channel=FakeChannel())
+
+    run_with_player(add_song)
+    assert len(queue.items) == QUEUE_SIZE + 1
+    assert queue.items[queue.cursor]['title'] == "Song 120"
+
+def test_history_is_trimmed_without_queue_loop(player_env):
+    queue = player_env
+    bot.guild_loop_states[GUILD_ID] = 'off'
+    queue.cursor = 119
+
+    async def add_song(player):
+        await player.send('enqueue', items=[make_song(QUEUE_SIZE)], channel=FakeChannel())
+
+    run_with_player(add_song)
+    assert len(queue.items) < QUEUE_SIZE
+    assert queue.items[queue.cursor]['title'] == "Song 120"
+
+class ForbiddenChannel:
+    async def send(self, *args, **kwargs):
+        raise discord.Forbidden(type('Response', (), {'status': 403, 'reason': 'Forbidden'})(), "Missing Permissions")
+
+def test_failed_now_playing_message_leaves_the_player_usable(player_env):
+    queue = player_env
+    bot.guild_loop_states[GUILD_ID] = 'off'
+    queue.clear()
+
+    async def play_twice(player):
+        await player.send('enqueue', items=[make_song(1)], channel=ForbiddenChannel())
+        assert player.state == 'playing'
+        player.guild.voice_client.stop() # The song ends...
+        player.post('track_end', generation=player.generation, error=None) # Its "Queue finished." fails the same way
+        await player.send('enqueue', items=[make_song(2)], channel=ForbiddenChannel()) # ...and the next request still plays
+        assert player.state == 'playing'
+        assert bot.current_song_info[GUILD_ID]['title'] == "Song 2"
+
+    run_with_player(play_twice)
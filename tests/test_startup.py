@@ -0,0 +1,27 @@
+"""Cold start checks: importing bot.py must not pull in the heavy modules it only needs later."""
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_PROBE = """
+import json, sys
+import bot
+print(json.dumps({
+    'yt_dlp': 'yt_dlp' in sys.modules,
+    'spotipy': 'spotipy' in sys.modules,
+}))
+"""
+
+def import_bot():
+    # A fresh interpreter, so nothing imported by pytest or other tests is already cached
+    result = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=REPO_ROOT,
+                            capture_output=True, text=True, timeout=60, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def test_heavy_modules_are_not_imported_at_startup():
+    probe = import_bot()
+    assert not probe['yt_dlp'], "yt_dlp must only be imported on first use (get_yt_dlp)"
+    assert not probe['spotipy'], "spotipy must only be imported once the bot is ready (init_spotify_client)"